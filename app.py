@@ -1,12 +1,15 @@
 import streamlit as st
 from datetime import datetime
-import tempfile
 import os
+import uuid
 
 # Import all the py files that serve as the backend
-from backend.ingest import extract_metadata_and_text
-from backend.vectorstore import create_faiss_index, search_index
-from backend.qa import ask_groq 
+from backend.docstore import get_document_store
+from backend.jobs import IngestJob, get_ingest_queue, spool_upload
+from backend.vectorstore import embed_query
+from backend.qa import CONTEXT_CANDIDATES, ask_groq_stream, build_context_from_chunks, model_name
+from backend.answer_cache import SemanticAnswerCache, context_key
+from backend import metrics
 # Import all the necessary functions required
 
  
@@ -16,6 +19,10 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# A finished upload job shows at most this many of its messages as toasts; all of them stay in the sidebar for
+# uploads that failed
+MAX_JOB_TOASTS = 3
+
 # CSS for the query bar 
 st.markdown("""
 <style>
@@ -50,17 +57,23 @@ def initialize_session_state():
     defaults = {
         "active_chat": None,
         "chats": {},
-        "chat_docs": {},
-        "chat_indexes": {},
-        "doc_details": {},
+        "chat_docs": {},      # chat name -> {file name: content hash}
+        "doc_details": {},    # content hash -> pages, metadata and hash of the document
+        "uploaded_file_ids": set(),
         "editing_index": None,
-        "viewing_doc_name": None
+        "viewing_doc_name": None,
+        "session_id": uuid.uuid4().hex,
+        "ingest_jobs": [],
+        "failed_uploads": {},  # chat name -> {file name: messages of the job that failed to add it}
+        "show_timings": False
     }
     for key, value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = value
 
 initialize_session_state()
+# The /metrics endpoint and the periodic timing log, when configured (see backend.metrics)
+metrics.start_exporters()
 
 
 # Making the sidebar for Chat and Document Management using streamlit
@@ -94,11 +107,20 @@ def display_sidebar():
         if active_chat:
             display_document_controls(active_chat)
 
+        if st.session_state.ingest_jobs:
+            display_ingest_progress()
+
+        if active_chat and st.session_state.failed_uploads.get(active_chat):
+            display_failed_uploads(active_chat)
+
+        st.divider()
+        st.toggle("Show timing breakdown", key="show_timings", help="Shows where the time of every answer went")
+
 # Renders UI for file filtering and manual re-indexing.
 def display_document_controls(chat_name):
     st.subheader("Documents & Search Filters")
     
-    chat_docs = st.session_state.chat_docs.get(chat_name, [])
+    chat_docs = list(st.session_state.chat_docs.get(chat_name, {}))
     if not chat_docs:
         st.info("Upload documents using the ➕ icon in the chat input to start.")
         return
@@ -117,9 +139,13 @@ def display_document_controls(chat_name):
     st.divider()
     st.markdown("##### View Documents")
     for doc_name in chat_docs:
-        if st.button(doc_name, key=f"view_{doc_name}", use_container_width=True):
+        col1, col2 = st.columns([0.85, 0.15])
+        if col1.button(doc_name, key=f"view_{doc_name}", use_container_width=True):
             st.session_state.viewing_doc_name = doc_name
             st.rerun()
+        if col2.button("🗑️", key=f"remove_{chat_name}_{doc_name}", help=f"Remove '{doc_name}' from this chat"):
+            remove_doc_from_chat(chat_name, doc_name)
+            st.rerun()
 
 
 # UI: Main Chat Interface 
@@ -153,13 +179,14 @@ def display_main_content():
 def render_document_viewer_expander():
     # Expands the document to view the contents
     doc_name = st.session_state.viewing_doc_name
-    if doc_name not in st.session_state.doc_details:
+    doc_data = get_chat_docs(st.session_state.active_chat).get(doc_name) if st.session_state.active_chat else None
+    if doc_data is None:
         st.error(f"Could not find details for document: {doc_name}")
         st.session_state.viewing_doc_name = None
         return
     with st.expander(f"📄 Viewing: {doc_name}", expanded=True):
         full_text = "\n\n".join(
-            page['text'] for page in st.session_state.doc_details[doc_name].get('pages', [])
+            page['text'] for page in doc_data.get('pages', [])
         )
         st.text_area("Document Content", value=full_text, height=500, disabled=True, label_visibility="collapsed")
         if st.button("Close Viewer", key="close_doc_viewer"):
@@ -188,9 +215,39 @@ def render_message(index, msg):
                 if st.button("✏️", key=f"edit_btn_{index}", help="Edit this prompt"):
                     st.session_state.editing_index = index
                     st.rerun()
+        if msg["role"] == "assistant" and msg.get("cached"):
+            st.caption("⚡ Answered from cache")
+        elif msg["role"] == "assistant" and msg.get("latency"):
+            display_latency(msg["latency"])
+        if msg["role"] == "assistant" and st.session_state.show_timings and msg.get("timings"):
+            display_timings(msg["timings"], msg.get("context_stats"))
         if msg["role"] == "assistant" and "chunks" in msg:
             display_citations(msg.get("chunks", []))
 
+def display_latency(latency):
+    first_token = latency.get("time_to_first_token")
+    parts = [f"first token {first_token:.2f}s"] if first_token is not None else []
+    parts.append(f"total {latency.get('total_latency', 0):.2f}s")
+    st.caption("⏱️ " + " · ".join(parts))
+
+def display_timings(timings, context_stats=None):
+    # Debug panel with the per-stage breakdown of one answer, slowest first, and what went into its prompt
+    with st.expander("⏱️ Timing breakdown"):
+        total = timings.get("query_total") or sum(timings.values())
+        rows = [
+            {"stage": stage.removeprefix("query_"), "ms": round(seconds * 1000, 1), "share": f"{seconds / total:.0%}" if total else ""}
+            for stage, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True) if stage != "query_total"
+        ]
+        st.dataframe(rows, hide_index=True, use_container_width=True)
+        st.caption(f"Total {total * 1000:.0f} ms. groq_total includes groq_first_token.")
+        if context_stats:
+            saved = context_stats['tokens_saved']
+            st.caption(
+                f"Context ~{context_stats['prompt_tokens']} tokens, {abs(saved)} {'fewer' if saved >= 0 else 'more'} than the top 5 chunks verbatim: "
+                f"{context_stats['merged']} chunk(s) merged, {context_stats['duplicates']} duplicate(s) and "
+                f"{context_stats['over_budget']} over budget dropped."
+            )
+
 def render_chat_input_bar(chat_name):
     # Uploading PDFs option
     col1, col2 = st.columns([0.1, 0.9])
@@ -203,88 +260,207 @@ def render_chat_input_bar(chat_name):
         if prompt:
             handle_user_query(prompt, chat_name)
 
+def unique_doc_name(name, taken):
+    # Two different files with the same name can live in one chat, the later one gets a numbered name
+    base, ext = os.path.splitext(name)
+    number = 2
+    while name in taken:
+        name = f"{base} ({number}){ext}"
+        number += 1
+    return name
+
 def process_and_index_uploads():
-    # Indexing the document after uploading
+    # Hands new uploads to the background ingest queue; the chat keeps working while they are OCR'd and indexed.
+    # Documents are identified by their content, so a file that this or any other session already read is added
+    # to the chat right away, whatever it's called
     chat_name = st.session_state.active_chat
     if not chat_name: return
     uploader_key = f"popover_uploader_{chat_name}"
     if uploader_key in st.session_state and st.session_state[uploader_key]:
         uploaded_files = st.session_state[uploader_key]
-        handle_file_upload(uploaded_files, chat_name)
-        handle_indexing(chat_name)
+        new_files = [file for file in uploaded_files if file.file_id not in st.session_state.uploaded_file_ids]
+        if not new_files:
+            return
+        chat_docs = st.session_state.chat_docs.setdefault(chat_name, {})
+        taken = set(chat_docs) | {name for job in st.session_state.ingest_jobs if job.chat_name == chat_name for name in job.documents}
+        queued_hashes = {file_hash for job in st.session_state.ingest_jobs if job.chat_name == chat_name for _, file_hash in job.files.values()}
+        docstore = get_document_store()
+        files, added = {}, 0
+        for file in new_files:
+            st.session_state.uploaded_file_ids.add(file.file_id)
+            # Copied to disk in pieces for the job, which reads it page by page
+            path, file_hash = spool_upload(file)
+            details = st.session_state.doc_details.get(file_hash) or docstore.document(file_hash)
+            if file_hash in chat_docs.values() or file_hash in queued_hashes or details is not None:
+                os.remove(path)
+                if details is not None and file_hash not in chat_docs.values():
+                    st.session_state.doc_details[file_hash] = details
+                    name = unique_doc_name(file.name, taken)
+                    taken.add(name)
+                    chat_docs[name] = file_hash
+                    added += 1
+                continue
+            name = unique_doc_name(file.name, taken)
+            taken.add(name)
+            queued_hashes.add(file_hash)
+            files[name] = (path, file_hash)
+        if added:
+            st.toast(f"✅ {added} document(s) were already processed and are ready.")
+        if files:
+            job = IngestJob((st.session_state.session_id, chat_name), files)
+            st.session_state.ingest_jobs.append(get_ingest_queue().submit(job))
+            st.toast(f"{len(files)} file(s) queued for processing.")
+
+def apply_finished_jobs():
+    # Adds the documents of finished jobs to their chats. Until then the chat answers from its other documents.
+    # What the job reported (OCR errors, skipped documents) is shown as toasts, and the uploads that didn't make it
+    # stay listed in the sidebar with those messages until they are dismissed
+    for job in list(st.session_state.ingest_jobs):
+        if job.status not in ("done", "failed"):
+            continue
+        st.session_state.ingest_jobs.remove(job)
+        for message in job.messages[:MAX_JOB_TOASTS]:
+            st.toast(message)
+        if len(job.messages) > MAX_JOB_TOASTS:
+            st.toast(f"…and {len(job.messages) - MAX_JOB_TOASTS} more message(s), see the sidebar.")
+        failed = [name for name in job.documents if name not in job.names]
+        if failed and job.chat_name in st.session_state.chats:
+            messages = job.messages + ([f"❌ Processing failed: {job.error}"] if job.error else [])
+            chat_failed = st.session_state.failed_uploads.setdefault(job.chat_name, {})
+            for name in failed:
+                chat_failed[name] = messages
+        if job.status == "failed":
+            st.toast(f"❌ Processing failed: {job.error}")
+            continue
+        if job.chat_name not in st.session_state.chats:
+            continue
+        st.session_state.doc_details.update(job.doc_details)
+        chat_docs = st.session_state.chat_docs.setdefault(job.chat_name, {})
+        for name, file_hash in job.names.items():
+            st.session_state.failed_uploads.get(job.chat_name, {}).pop(name, None)
+            if file_hash not in chat_docs.values():
+                chat_docs[unique_doc_name(name, chat_docs)] = file_hash
+        st.toast(f"✅ {len(job.names)} document(s) ready in '{job.chat_name}'.")
+
+@st.fragment(run_every=1)
+def display_ingest_progress():
+    # Polls the running jobs of this session and reruns the app once one of them has finished
+    jobs = st.session_state.ingest_jobs
+    st.markdown("##### Processing uploads")
+    for job in jobs:
+        for name, progress in list(job.documents.items()):
+            pages = f"{progress['pages_done']}/{progress['pages_total']} pages" if progress['pages_total'] else ""
+            chunks = f"{progress['chunks_embedded']} chunks" if progress['chunks_embedded'] else ""
+            details = " · ".join(part for part in (progress['status'], pages, chunks) if part)
+            # Pages are read and embedded together, so reading is the best measure of how far along a document is
+            if progress['pages_total']:
+                done = progress['pages_done'] / progress['pages_total']
+            else:
+                done = progress['chunks_embedded'] / progress['chunks_total'] if progress['chunks_total'] else 0.0
+            st.progress(done, text=f"{name}: {details}")
+    if any(job.status in ("done", "failed") for job in jobs):
+        st.rerun()
+
+def display_failed_uploads(chat_name):
+    st.markdown("##### Failed uploads")
+    failed = st.session_state.failed_uploads[chat_name]
+    for name, messages in list(failed.items()):
+        col1, col2 = st.columns([0.85, 0.15])
+        with col1.expander(f"❌ {name}"):
+            for message in messages or ["No details were reported."]:
+                st.caption(message)
+        if col2.button("✖️", key=f"dismiss_{chat_name}_{name}", help=f"Dismiss '{name}'"):
+            failed.pop(name)
+            st.rerun()
 
-def handle_file_upload(uploaded_files, chat_name):
-    with st.spinner("Processing uploaded files..."):
-        if chat_name not in st.session_state.chat_docs:
-            st.session_state.chat_docs[chat_name] = []
-        for file in uploaded_files:
-            if file.name not in st.session_state.doc_details:
-                tmp_path = None
-                try:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                        tmp.write(file.getvalue())
-                        tmp_path = tmp.name
-                    if tmp_path:
-                        pages, metadata = extract_metadata_and_text(tmp_path)
-                        if pages:
-                            st.session_state.doc_details[file.name] = {'pages': pages, 'metadata': metadata}
-                finally:
-                    if tmp_path and os.path.exists(tmp_path):
-                        os.remove(tmp_path)
-            if file.name not in st.session_state.chat_docs[chat_name]:
-                st.session_state.chat_docs[chat_name].append(file.name)
-    st.toast(f"{len(uploaded_files)} file(s) processed.")
+def get_chat_docs(chat_name):
+    # The chat's view of the shared document store: {file name: document details}
+    return {name: st.session_state.doc_details[file_hash] for name, file_hash in st.session_state.chat_docs.get(chat_name, {}).items() if file_hash in st.session_state.doc_details}
 
 def handle_indexing(chat_name):
+    # Documents live in the shared document store, which drops the ones nobody used for a while. This puts all of the
+    # chat's documents back in (from the embedding cache, so nothing is embedded twice)
+    docs = get_chat_docs(chat_name)
+    if not docs:
+        st.warning("No documents available to index.")
+        return
+    docstore = get_document_store()
     with st.spinner("Indexing documents... This may take a moment."):
-        docs_to_index = {name: st.session_state.doc_details[name] for name in st.session_state.chat_docs.get(chat_name, []) if name in st.session_state.doc_details}
-        if not docs_to_index:
-            st.warning("No documents available to index.")
-            return
-        index, metadata = create_faiss_index(docs_to_index)
-        if index is not None:
-            st.session_state.chat_indexes[chat_name] = {'index': index, 'metadata': metadata}
-            st.toast("Documents indexed successfully!")
+        missing = {name: details for name, details in docs.items() if details['hash'] not in docstore}
+        failed = [name for name, details in missing.items() if not docstore.add(details)]
+    if failed:
+        st.error(f"Could not index: {', '.join(failed)}")
+    else:
+        st.toast(f"All {len(docs)} document(s) are indexed.")
+
+def remove_doc_from_chat(chat_name, doc_name):
+    # Drops the document from the chat. It stays in the shared store for other chats and sessions
+    st.session_state.chat_docs.get(chat_name, {}).pop(doc_name, None)
+    if st.session_state.viewing_doc_name == doc_name:
+        st.session_state.viewing_doc_name = None
+
+@st.cache_resource(show_spinner=False)
+def get_answer_cache():
+    # Shared by all sessions, since users tend to ask the same questions about the same documents
+    return SemanticAnswerCache()
 
 def handle_user_query(user_input, chat_name, is_edit=False, edit_index=None):
     if is_edit and edit_index is not None:
         st.session_state.chats[chat_name] = st.session_state.chats[chat_name][:edit_index]
     st.session_state.chats[chat_name].append({"role": "user", "content": user_input})
-    with st.spinner("Searching and generating answer..."):
-        response, top_chunks = "", []
-        index_data = st.session_state.chat_indexes.get(chat_name)
-        if index_data:
-            filters = st.session_state.get(f'filters_{chat_name}', {})
-            initial_results = search_index(user_input, index_data["index"], index_data["metadata"], top_k=25)
-            filtered_results = apply_search_filters(initial_results, filters)
-            top_chunks = filtered_results[:5]
-        if top_chunks:
-            st.toast("✅ Found relevant context in your documents.")
-            context = build_context_from_chunks(top_chunks)
-            response = ask_groq(user_input, context)
-        else:
-            if index_data: st.toast("ℹ️ No specific context found. Answering generally.")
-            response = ask_groq(user_input, context=None) 
-        st.session_state.chats[chat_name].append({"role": "assistant", "content": response, "chunks": top_chunks})
+    # Every stage of the answer is timed into the process-wide histograms and into this answer's breakdown
+    timings = {}
+    with metrics.span("query_total", timings):
+        with st.spinner("Searching your documents..."):
+            context, top_chunks, query_vector, context_stats = None, [], None, {}
+            chat_docs = get_chat_docs(chat_name)
+            if chat_docs:
+                # General chat never needs the embedding model, so it is only loaded once there are documents to search
+                try:
+                    with metrics.span("query_embed", timings):
+                        query_vector = embed_query(user_input)
+                except RuntimeError as e:
+                    # Without the model the documents can't be searched, but the question is still answered generally
+                    st.error(f"❌ {e}")
+                    chat_docs = {}
+            if chat_docs:
+                filters = st.session_state.get(f'filters_{chat_name}', {})
+                included_docs = get_included_docs(filters)
+                search_docs = {name: details for name, details in chat_docs.items() if included_docs is None or name in included_docs}
+                # More candidates than fit in the prompt are fetched; packing merges, dedupes and trims them to the token budget
+                top_chunks = get_document_store().search(user_input, search_docs, top_k=CONTEXT_CANDIDATES, query_vector=query_vector, timings=timings, with_vectors=True)
+            if top_chunks:
+                st.toast("✅ Found relevant context in your documents.")
+                with metrics.span("query_context", timings):
+                    context = build_context_from_chunks(top_chunks, stats=context_stats)
+                # The citations are the packed sources, numbered as in the prompt. Vectors aren't kept in the chat history
+                top_chunks = [{key: value for key, value in source.items() if key != "vector"} for source in context_stats["sources"]]
+                context_stats.pop("sources")
+            elif chat_docs:
+                st.toast("ℹ️ No specific context found. Answering generally.")
+        # A near-duplicate question over the same context is answered from the cache without calling Groq
+        answer_cache = get_answer_cache()
+        with metrics.span("query_cache", timings):
+            cache_key = context_key(context, model_name)
+            response = answer_cache.lookup(query_vector, cache_key) if query_vector is not None else None
+        latency, cached = {}, response is not None
+        if not cached:
+            # The answer is rendered token by token while it is generated instead of after the whole reply arrived
+            with st.chat_message("assistant"):
+                response = st.write_stream(ask_groq_stream(user_input, context, stats=latency)).strip()
+            if query_vector is not None and not response.startswith(("❌", "⚠️")):
+                answer_cache.store(query_vector, cache_key, response)
+            timings["query_groq_first_token"] = latency.get("time_to_first_token", 0.0)
+            timings["query_groq_total"] = latency.get("total_latency", 0.0)
+    st.session_state.chats[chat_name].append({"role": "assistant", "content": response, "chunks": top_chunks, "latency": latency, "cached": cached, "timings": timings, "context_stats": context_stats})
     st.rerun()
 
-def apply_search_filters(results, filters):
-    # Manually select and deselect documents to search from them
+def get_included_docs(filters):
+    # Manually select and deselect documents to search from them. None means every document is searched
     if not filters or 'included_docs' not in filters:
-        return results
-    
-    included_docs = filters['included_docs']
-    if not included_docs:
-        return results 
-    """ This filter first gets all the context and then depending on the deselected documents, it gets rid of the contexts that isn't included. """
-    return [chunk for chunk in results if chunk['doc_name'] in included_docs]
-
-def build_context_from_chunks(chunks):
-    if not chunks: return None
-    return "\n\n---\n\n".join(
-        f"Source [{i+1}] from Document '{chunk['doc_name']}', Page {chunk['page_number']}:\nContent: {chunk['text']}"
-        for i, chunk in enumerate(chunks)
-    )
+        return None
+    """ Only the selected documents are searched, restricted inside the shared index itself. """
+    return filters['included_docs'] or None
 
 def display_citations(chunks):
     # For displaying the particular contexts and the page number along with the phrase
@@ -300,7 +476,7 @@ def delete_chat(chat_name):
     # The option to delete the chats
     st.session_state.chats.pop(chat_name, None)
     st.session_state.chat_docs.pop(chat_name, None)
-    st.session_state.chat_indexes.pop(chat_name, None)
+    st.session_state.failed_uploads.pop(chat_name, None)
     st.session_state.pop(f'filters_{chat_name}', None)
     if st.session_state.active_chat == chat_name:
         st.session_state.active_chat = None
@@ -308,5 +484,6 @@ def delete_chat(chat_name):
 
 # Main app
 if __name__ == "__main__":
+    apply_finished_jobs()
     display_sidebar()
     display_main_content()
@@ -0,0 +1,83 @@
+# backend/answer_cache.py
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# A cached answer is reused when the new question is at least this similar (cosine) to the cached one
+SIMILARITY_THRESHOLD = float(os.environ.get("DOCBOT_ANSWER_CACHE_THRESHOLD", 0.95))
+TTL_SECONDS = float(os.environ.get("DOCBOT_ANSWER_CACHE_TTL", 3600))
+MAX_ENTRIES = int(os.environ.get("DOCBOT_ANSWER_CACHE_SIZE", 1024))
+
+
+def context_key(context: str | None, model: str) -> str:
+    # Identifies exactly what the model would see besides the question: the retrieved context (or none) and the model
+    return hashlib.sha256(f"{model}\n{context or ''}".encode("utf-8")).hexdigest()
+
+
+class SemanticAnswerCache:
+    """ Answers keyed by the question's embedding and the retrieved context. A lookup only considers entries with the
+    same context, and returns the most similar one above the threshold. Entries expire after ttl_seconds and the least
+    recently used ones are dropped beyond max_entries. Safe to share between sessions."""
+
+    def __init__(self, similarity_threshold: float = SIMILARITY_THRESHOLD, ttl_seconds: float = TTL_SECONDS, max_entries: int = MAX_ENTRIES):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # entry id -> (context key, unit query vector, answer, created)
+        self._by_context = {}          # context key -> set of entry ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _normalize(query_vector) -> np.ndarray:
+        vector = np.asarray(query_vector, dtype='float32').reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _drop(self, entry_id):
+        key = self._entries.pop(entry_id)[0]
+        ids = self._by_context.get(key)
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._by_context[key]
+
+    def lookup(self, query_vector, key: str) -> str | None:
+        vector = self._normalize(query_vector)
+        now = time.time()
+        with self._lock:
+            best_id, best_similarity = None, self.similarity_threshold
+            for entry_id in list(self._by_context.get(key, ())):
+                _, cached_vector, _, created = self._entries[entry_id]
+                if now - created > self.ttl_seconds:
+                    self._drop(entry_id)
+                    continue
+                similarity = float(np.dot(vector, cached_vector))
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][2]
+
+    def store(self, query_vector, key: str, answer: str):
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (key, self._normalize(query_vector), answer, time.time())
+            self._by_context.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_context.clear()
@@ -0,0 +1,275 @@
+# backend/cache.py
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+# Persistent cache for OCR output and chunk embeddings. Entries are addressed by the hash of the file contents
+# plus the pipeline settings that produced them, so the same PDF uploaded from any session (or after a restart)
+# reuses the earlier work, while changing e.g. the OCR DPI or the embedding model never returns stale results.
+CACHE_DIR = os.environ.get("DOCBOT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "docbot"))
+# Total size the cache may take on disk before the least recently used entries are evicted
+CACHE_MAX_BYTES = int(os.environ.get("DOCBOT_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+# The shared document store keeps a snapshot of its index here. It is not an entry, so the size cap doesn't apply
+DOCSTORE_DIR = os.environ.get("DOCBOT_DOCSTORE_DIR", os.path.join(CACHE_DIR, "docstore"))
+
+# Pages and chunks are appended one JSON object per line while a document streams through the pipeline;
+# vectors are raw float32 rows whose count and dimension are in meta.json, which is written last
+PAGES_FILE = "pages.jsonl"
+CHUNKS_FILE = "chunks.jsonl"
+VECTORS_FILE = "vectors.f32"
+META_FILE = "meta.json"
+
+
+def entry_key(kind: str, file_hash: str, settings: dict) -> str:
+    settings_blob = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha256(f"{kind}:{file_hash}:{settings_blob}".encode("utf-8")).hexdigest()
+
+
+def entry_dir(key: str) -> str:
+    return os.path.join(CACHE_DIR, key[:2], key)
+
+
+def touch(path: str):
+    # The directory mtime doubles as the "last used" stamp for LRU eviction
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _enforce_size_cap():
+    # Evicts the least recently used entries until the cache fits within CACHE_MAX_BYTES
+    if not os.path.isdir(CACHE_DIR):
+        return
+    entries = []
+    for shard in os.listdir(CACHE_DIR):
+        shard_dir = os.path.join(CACHE_DIR, shard)
+        # Entries live in two-character shard directories; anything else (the document store snapshot) is left alone
+        if len(shard) != 2 or not os.path.isdir(shard_dir):
+            continue
+        for key in os.listdir(shard_dir):
+            path = os.path.join(shard_dir, key)
+            # Entries still being written live in ".tmp-" directories and are left alone
+            if os.path.isdir(path) and not key.startswith(".tmp-"):
+                entries.append((os.path.getmtime(path), _dir_size(path), path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def write_directory(final_dir: str, files: dict):
+    # Writes all files ({name: writer(path)}) into a temporary directory first and then renames it into place,
+    # so a reader never sees a half written directory
+    os.makedirs(os.path.dirname(final_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(final_dir))
+    try:
+        for name, writer in files.items():
+            writer(os.path.join(tmp_dir, name))
+        if os.path.isdir(final_dir):
+            shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+    finally:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def write_json(obj):
+    def writer(path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(obj, f)
+    return writer
+
+
+def encode_doc_metadata(metadata: dict) -> dict:
+    encoded = dict(metadata)
+    if isinstance(encoded.get("creation_date"), datetime):
+        encoded["creation_date"] = encoded["creation_date"].isoformat()
+    return encoded
+
+
+def decode_doc_metadata(metadata: dict) -> dict:
+    decoded = dict(metadata)
+    if decoded.get("creation_date"):
+        decoded["creation_date"] = datetime.fromisoformat(decoded["creation_date"])
+    return decoded
+
+
+def _read_meta(entry: str) -> dict | None:
+    try:
+        with open(os.path.join(entry, META_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class CachedPages:
+    """ The pages of a cached document, read from disk line by line whenever they are iterated instead of being
+    kept in memory. Works where a list of page dicts is expected for iterating and len()."""
+
+    def __init__(self, entry: str, count: int):
+        self.entry = entry
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        touch(self.entry)
+        try:
+            with open(os.path.join(self.entry, PAGES_FILE), encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+        except OSError as e:
+            # The entry was evicted since it was loaded
+            print(f"Could not read cached pages: {e}")
+
+
+def load_pages(file_hash: str, settings: dict) -> tuple[CachedPages, dict] | None:
+    # Returns the cached (pages, metadata) of a document, or None on a miss
+    entry = entry_dir(entry_key("pages", file_hash, settings))
+    meta = _read_meta(entry)
+    if meta is None or not os.path.exists(os.path.join(entry, PAGES_FILE)):
+        return None
+    touch(entry)
+    return CachedPages(entry, meta["count"]), decode_doc_metadata(meta["metadata"])
+
+
+def load_chunks(file_hash: str, settings: dict) -> tuple[list[dict], np.ndarray] | None:
+    # Returns the cached chunks ({"text", "page_number"}) of a document and their float32 vectors.
+    # The vectors are memory-mapped, so a hit costs almost nothing until the rows are actually used
+    entry = entry_dir(entry_key("chunks", file_hash, settings))
+    meta = _read_meta(entry)
+    if meta is None:
+        return None
+    try:
+        with open(os.path.join(entry, CHUNKS_FILE), encoding="utf-8") as f:
+            chunks = [json.loads(line) for line in f]
+        shape = (meta["count"], meta["dimension"])
+        if meta["count"]:
+            vectors = np.memmap(os.path.join(entry, VECTORS_FILE), dtype="float32", mode="r", shape=shape)
+        else:
+            vectors = np.empty(shape, dtype="float32")
+    except (OSError, ValueError, KeyError):
+        return None
+    if len(chunks) != vectors.shape[0]:
+        return None
+    touch(entry)
+    return chunks, vectors
+
+
+def touch_chunks(file_hash: str, settings: dict) -> bool:
+    # Marks a document's embedding cache entry as just used, so LRU eviction gets to it last. False when there is none
+    entry = entry_dir(entry_key("chunks", file_hash, settings))
+    if _read_meta(entry) is None:
+        return False
+    touch(entry)
+    return True
+
+
+class _EntryWriter:
+    """ Builds a cache entry incrementally in a temporary directory. commit() moves the finished entry into place;
+    abort() throws it away. Nothing of it is visible to readers before the commit."""
+
+    def __init__(self, kind: str, file_hash: str, settings: dict):
+        self.key = entry_key(kind, file_hash, settings)
+        final_dir = entry_dir(self.key)
+        os.makedirs(os.path.dirname(final_dir), exist_ok=True)
+        self.tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(final_dir))
+        self.count = 0
+
+    def _close(self):
+        pass
+
+    def commit(self, meta: dict):
+        self._close()
+        write_json({**meta, "count": self.count, "created": time.time()})(os.path.join(self.tmp_dir, META_FILE))
+        final_dir = entry_dir(self.key)
+        if os.path.isdir(final_dir):
+            shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(self.tmp_dir, final_dir)
+        _enforce_size_cap()
+
+    def abort(self):
+        self._close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class PagesWriter(_EntryWriter):
+    # Appends the pages of one document to its OCR cache entry as they come out of the reader
+
+    def __init__(self, file_hash: str, settings: dict):
+        super().__init__("pages", file_hash, settings)
+        self._pages = open(os.path.join(self.tmp_dir, PAGES_FILE), "w", encoding="utf-8")
+
+    def append(self, page: dict):
+        self._pages.write(json.dumps(page) + "\n")
+        self.count += 1
+
+    def _close(self):
+        self._pages.close()
+
+    def commit(self, metadata: dict):
+        super().commit({"metadata": encode_doc_metadata(metadata)})
+
+
+class ChunkVectorWriter(_EntryWriter):
+    # Appends the chunks of one document and their vectors to its embedding cache entry, window by window
+
+    def __init__(self, file_hash: str, settings: dict):
+        super().__init__("chunks", file_hash, settings)
+        self.dimension = 0
+        self._chunks = open(os.path.join(self.tmp_dir, CHUNKS_FILE), "w", encoding="utf-8")
+        self._vectors = open(os.path.join(self.tmp_dir, VECTORS_FILE), "wb")
+
+    def append(self, chunks: list[dict], vectors: np.ndarray):
+        for chunk in chunks:
+            self._chunks.write(json.dumps({"text": chunk["text"], "page_number": chunk["page_number"]}) + "\n")
+        self._vectors.write(np.ascontiguousarray(vectors, dtype="float32").tobytes())
+        self.dimension = vectors.shape[1]
+        self.count += len(chunks)
+
+    def _close(self):
+        self._chunks.close()
+        self._vectors.close()
+
+    def commit(self):
+        super().commit({"dimension": self.dimension})
+
+
+def open_pages_writer(file_hash: str, settings: dict) -> PagesWriter | None:
+    try:
+        return PagesWriter(file_hash, settings)
+    except OSError as e:
+        print(f"Could not write OCR cache entry: {e}")
+        return None
+
+
+def open_chunk_writer(file_hash: str, settings: dict) -> ChunkVectorWriter | None:
+    try:
+        return ChunkVectorWriter(file_hash, settings)
+    except OSError as e:
+        print(f"Could not write embedding cache entry: {e}")
+        return None
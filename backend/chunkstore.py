@@ -0,0 +1,189 @@
+# backend/chunkstore.py
+
+import json
+import mmap
+import os
+from array import array
+
+import numpy as np
+
+from backend import cache
+from backend.lexical import BM25Index
+
+DOCS_FILE = "docs.json"
+COLUMNS_FILE = "columns.npz"
+TEXT_FILE = "text.bin"
+
+
+class ChunkStore:
+    """ Column-oriented metadata for the chunks of an index. Row i describes the vector with FAISS ID i.
+    Per chunk only a document position, a page number and an offset into one shared UTF-8 text buffer are kept;
+    author, title, creation date etc. live once per document. Dicts are only built for the rows a search returns.
+    The store also keeps a BM25 inverted index over the same rows for exact-term lookups."""
+
+    def __init__(self):
+        self.doc_names: list[str] = []
+        self.doc_metadata: list[dict] = []
+        self._doc_positions: dict[str, int] = {}
+        self._doc_ranges: dict[int, list[list[int]]] = {}  # Document position -> [start, end) row ranges
+        self.doc_ids = array('i')
+        self.page_numbers = array('i')
+        self.text_offsets = array('q', [0])  # Text of row i is text[text_offsets[i]:text_offsets[i + 1]]
+        self.alive = bytearray()             # 0 once a row's document was removed
+        self._text = bytearray()
+        self._mapped_file = None
+        self.lexical = BM25Index()
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @property
+    def live_count(self) -> int:
+        return len(self.alive) - self.alive.count(0)
+
+    def copy(self) -> "ChunkStore":
+        # An independent copy, to add to or remove from while searches keep reading this one
+        other = ChunkStore()
+        other.doc_names = list(self.doc_names)
+        other.doc_metadata = list(self.doc_metadata)
+        other._doc_positions = dict(self._doc_positions)
+        other._doc_ranges = {position: [list(r) for r in ranges] for position, ranges in self._doc_ranges.items()}
+        other.doc_ids = array('i', self.doc_ids)
+        other.page_numbers = array('i', self.page_numbers)
+        other.text_offsets = array('q', self.text_offsets)
+        other.alive = bytearray(self.alive)
+        other._text = bytearray(self._text)
+        other.lexical = self.lexical.copy()
+        return other
+
+    # Writing
+
+    def add_document(self, doc_name: str, doc_meta: dict) -> int:
+        # Returns the position of the document in the document table, adding it when it's new
+        if doc_name not in self._doc_positions:
+            self._doc_positions[doc_name] = len(self.doc_names)
+            self.doc_names.append(doc_name)
+            self.doc_metadata.append(dict(doc_meta))
+        return self._doc_positions[doc_name]
+
+    def append(self, doc_position: int, page_number: int, text: str) -> int:
+        # A document's rows are appended in one go, so they form one range (another one if it's added back later)
+        row = len(self.doc_ids)
+        ranges = self._doc_ranges.setdefault(doc_position, [])
+        if ranges and ranges[-1][1] == row:
+            ranges[-1][1] = row + 1
+        else:
+            ranges.append([row, row + 1])
+        self._text.extend(text.encode("utf-8"))
+        self.doc_ids.append(doc_position)
+        self.page_numbers.append(page_number or 0)
+        self.text_offsets.append(len(self._text))
+        self.alive.append(1)
+        self.lexical.add(len(self.doc_ids) - 1, text)
+        return len(self.doc_ids) - 1
+
+    def remove_rows(self, ids):
+        for i in ids:
+            self.alive[i] = 0
+        self.lexical.remove(ids)
+
+    def remove_documents(self, doc_names) -> np.ndarray:
+        # Marks the rows of the given documents as removed and returns their IDs
+        ids = self.rows_for_documents(doc_names)
+        self.remove_rows(ids)
+        return ids
+
+    # Reading
+
+    def is_alive(self, row: int) -> bool:
+        return 0 <= row < len(self.alive) and self.alive[row] == 1
+
+    def text(self, row: int) -> str:
+        return bytes(self._text[self.text_offsets[row]:self.text_offsets[row + 1]]).decode("utf-8")
+
+    def doc_name(self, row: int) -> str:
+        return self.doc_names[self.doc_ids[row]]
+
+    def row(self, row: int) -> dict:
+        # Dict view of one chunk, with the same keys the per-chunk dicts used to have
+        doc_name = self.doc_name(row)
+        page_number = self.page_numbers[row]
+        chunk_meta = {
+            "doc_name": doc_name,
+            "chunk_id": f"{doc_name}_page{page_number}_chunk{row}", # Unique ID for citations
+            "text": self.text(row),
+            "page_number": page_number,
+            "row": row,
+        }
+        chunk_meta.update(self.doc_metadata[self.doc_ids[row]])
+        return chunk_meta
+
+    def rows(self, ids) -> list[dict]:
+        return [self.row(int(i)) for i in ids if self.is_alive(int(i))]
+
+    def live_rows(self) -> np.ndarray:
+        return np.flatnonzero(np.frombuffer(self.alive, dtype=np.uint8)).astype('int64')
+
+    def rows_for_documents(self, doc_names) -> np.ndarray:
+        # Live rows of the given documents, from their row ranges rather than a scan over every row
+        ranges = [r for name in doc_names if name in self._doc_positions for r in self._doc_ranges.get(self._doc_positions[name], [])]
+        if not ranges:
+            return np.empty(0, dtype='int64')
+        rows = np.concatenate([np.arange(start, end, dtype='int64') for start, end in ranges])
+        return rows[np.frombuffer(self.alive, dtype=np.uint8)[rows].astype(bool)]
+
+    def row_mask(self, rows: np.ndarray) -> np.ndarray:
+        # Boolean mask over all rows that is True for the given ones
+        mask = np.zeros(len(self), dtype=bool)
+        mask[rows] = True
+        return mask
+
+    def indexed_doc_names(self) -> set[str]:
+        if not len(self):
+            return set()
+        live_docs = np.unique(np.frombuffer(self.doc_ids, dtype=np.int32)[self.live_rows()])
+        return {self.doc_names[i] for i in live_docs}
+
+    # Persistence
+
+    def files(self) -> dict:
+        # Writers for cache.write_directory
+        def write_columns(path):
+            with open(path, "wb") as f:
+                np.savez(f, doc_ids=np.frombuffer(self.doc_ids, dtype=np.int32), page_numbers=np.frombuffer(self.page_numbers, dtype=np.int32),
+                         text_offsets=np.frombuffer(self.text_offsets, dtype=np.int64), alive=np.frombuffer(self.alive, dtype=np.uint8))
+
+        def write_text(path):
+            with open(path, "wb") as f:
+                f.write(self._text)
+
+        docs = [{"doc_name": name, "metadata": cache.encode_doc_metadata(meta)} for name, meta in zip(self.doc_names, self.doc_metadata)]
+        return {DOCS_FILE: cache.write_json({"docs": docs}), COLUMNS_FILE: write_columns, TEXT_FILE: write_text, **self.lexical.files()}
+
+    @classmethod
+    def load(cls, directory: str) -> "ChunkStore":
+        # The text buffer is memory-mapped read-only; the small fixed-width columns are read into memory.
+        # A loaded store is only read from: copy() it to add or remove rows
+        store = cls()
+        with open(os.path.join(directory, DOCS_FILE), encoding="utf-8") as f:
+            for entry in json.load(f)["docs"]:
+                store.add_document(entry["doc_name"], cache.decode_doc_metadata(entry["metadata"]))
+        with np.load(os.path.join(directory, COLUMNS_FILE)) as columns:
+            doc_ids = columns["doc_ids"].astype(np.int32)
+            store.doc_ids = array('i', doc_ids.tobytes())
+            store.page_numbers = array('i', columns["page_numbers"].astype(np.int32).tobytes())
+            store.text_offsets = array('q', columns["text_offsets"].astype(np.int64).tobytes())
+            store.alive = bytearray(columns["alive"].astype(np.uint8).tobytes())
+        # Row ranges are the runs of equal document positions
+        if doc_ids.size:
+            starts = np.flatnonzero(np.concatenate(([True], doc_ids[1:] != doc_ids[:-1])))
+            ends = np.append(starts[1:], doc_ids.size)
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                store._doc_ranges.setdefault(int(doc_ids[start]), []).append([start, end])
+        store.lexical = BM25Index.load(directory)
+
+        text_path = os.path.join(directory, TEXT_FILE)
+        if os.path.getsize(text_path):
+            store._mapped_file = open(text_path, "rb")
+            store._text = mmap.mmap(store._mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return store
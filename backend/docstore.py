@@ -0,0 +1,216 @@
+# backend/docstore.py
+
+import json
+import os
+import threading
+import time
+
+import streamlit as st
+
+from backend import cache
+from backend.cache import load_pages
+from backend.chunkstore import ChunkStore
+from backend.indexes import copy_index, read_index, write_index
+from backend.ingest import ocr_settings
+from backend.vectorstore import add_documents_to_index, embed_document, embedding_settings, remove_documents_from_index, search_index
+
+# Documents no chat has searched or added for this long are dropped from memory. They come back from the embedding
+# cache on disk, without re-embedding, the next time a chat needs them; documents whose cache entry is gone stay
+IDLE_SECONDS = float(os.environ.get("DOCBOT_DOCSTORE_IDLE_SECONDS", 3600))
+# The store is rebuilt without its dead rows once they make up this share of it
+COMPACT_DEAD_RATIO = 0.5
+
+# Snapshot files, next to the chunk store's own files
+INDEX_FILE = "index.faiss"
+STATE_FILE = "documents.json"
+
+
+def _needs_compaction(store: ChunkStore) -> bool:
+    return bool(len(store)) and store.live_count < len(store) * (1 - COMPACT_DEAD_RATIO)
+
+
+class DocumentStore:
+    """ One FAISS index and chunk store for every document in the process, keyed by content hash. A document is
+    embedded and held in memory once, however many chats and sessions use it, and under whatever file names.
+    A chat only keeps a view, {file name: document details}, and searches the shared index restricted to the
+    documents of that view. Safe to share between sessions and background jobs.
+    The published index and chunk store are never modified. Writers (adding, evicting, compacting) take turns and
+    work on copies, and the lock is only held to swap the finished copies in, so searches never wait for a build.
+    With a directory, every change is saved there (faiss.write_index plus the chunk store's files), and open()
+    starts from that snapshot, memory-mapped, so a restart doesn't have to rebuild anything."""
+
+    def __init__(self, directory: str | None = None):
+        self.index = None
+        self.store = ChunkStore()
+        self._docs = {}  # content hash -> document details ('pages', 'metadata', 'hash') plus 'last_used'
+        self._lock = threading.RLock()        # Guards index, store and _docs, which are swapped together
+        self._write_lock = threading.Lock()   # One writer at a time
+        self._directory = directory
+        self._mapped_from = None              # Index file the published index is memory-mapped from
+
+    @classmethod
+    def open(cls, directory: str) -> "DocumentStore":
+        # A store that saves to directory, starting from the snapshot there when it was made with the current settings
+        docstore = cls(directory)
+        index_path = os.path.join(directory, INDEX_FILE)
+        try:
+            with open(os.path.join(directory, STATE_FILE), encoding="utf-8") as f:
+                state = json.load(f)
+            if state["settings"] != json.loads(json.dumps(embedding_settings())):
+                print("Embedding settings changed since the document store was saved; starting empty")
+                return docstore
+            store = ChunkStore.load(directory)
+            index = read_index(index_path) if os.path.exists(index_path) else None
+        except FileNotFoundError:
+            return docstore
+        except (OSError, ValueError, KeyError, RuntimeError) as e:
+            print(f"Could not load the document store: {e}")
+            return docstore
+
+        docs = {}
+        for file_hash, saved in state["documents"].items():
+            cached = load_pages(file_hash, ocr_settings())
+            metadata = cache.decode_doc_metadata(saved["metadata"])
+            docs[file_hash] = {'pages': cached[0] if cached else [], 'metadata': metadata, 'hash': file_hash, 'last_used': saved["last_used"]}
+        docstore.index, docstore.store, docstore._docs = index, store, docs
+        docstore._mapped_from = index_path if index is not None else None
+        return docstore
+
+    def __contains__(self, file_hash: str) -> bool:
+        with self._lock:
+            return file_hash in self._docs
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._docs)
+
+    def document(self, file_hash: str) -> dict | None:
+        # Details of a document that is in the store, e.g. one another session uploaded
+        with self._lock:
+            details = self._docs.get(file_hash)
+            return {key: value for key, value in details.items() if key != 'last_used'} if details else None
+
+    def _snapshot(self):
+        with self._lock:
+            return self.index, self.store, dict(self._docs)
+
+    def _copy_index(self, index):
+        return copy_index(index, self._mapped_from)
+
+    def _publish(self, index, store: ChunkStore, docs: dict):
+        # Called by the writer holding _write_lock
+        with self._lock:
+            self.index, self.store, self._docs = index, store, docs
+            self._mapped_from = None
+        self._save(index, store, docs)
+
+    def _save(self, index, store: ChunkStore, docs: dict):
+        if self._directory is None:
+            return
+        state = {
+            "settings": embedding_settings(),
+            "documents": {file_hash: {"metadata": cache.encode_doc_metadata(details['metadata']), "last_used": details['last_used']}
+                          for file_hash, details in docs.items()},
+        }
+        files = {STATE_FILE: cache.write_json(state), **store.files()}
+        if index is not None:
+            files[INDEX_FILE] = lambda path: write_index(index, path)
+        try:
+            cache.write_directory(self._directory, files)
+        except (OSError, RuntimeError) as e:
+            print(f"Could not save the document store: {e}")
+
+    def add(self, details: dict, progress=None, notify=None) -> bool:
+        # Makes sure a document is in the shared index. Returns False when it has nothing to index
+        file_hash = details['hash']
+        with self._lock:
+            if file_hash in self._docs:
+                self._docs[file_hash]['last_used'] = time.time()
+                return True
+
+        # The embedding goes into the embedding cache first; adding the cached vectors to a copy of the index is
+        # quick, unless the index grows past the point where it is rebuilt as an approximate one
+        try:
+            if embed_document(details, progress, notify) is False:
+                return False
+        except RuntimeError as e:
+            # E.g. the embedding model couldn't be loaded
+            (notify or st.error)(f"❌ {e}")
+            return False
+        with self._write_lock:
+            index, store, docs = self._snapshot()
+            if file_hash not in docs:
+                index, store = add_documents_to_index(self._copy_index(index), store.copy(), {file_hash: details}, notify=notify)
+                if file_hash not in store.indexed_doc_names():
+                    return False
+                docs[file_hash] = {**details, 'last_used': time.time()}
+                self._publish(index, store, docs)
+        self._maintain()
+        return True
+
+    def search(self, query: str, docs: dict[str, dict], top_k: int = 10, query_vector=None, timings=None, with_vectors=False, notify=None) -> list[dict]:
+        # Searches the documents of one view ({file name: details}). Documents that were evicted meanwhile are
+        # added back first; the ones that can't be are reported through notify (st.error by default).
+        # The hits carry the view's file names rather than the content hashes
+        names, lost = {}, []
+        for name, details in docs.items():
+            names.setdefault(details['hash'], name)
+            if details['hash'] not in self and not self.add(details, notify=notify):
+                lost.append(name)
+        if lost:
+            (notify or st.error)(f"❌ Could not load {', '.join(lost)} back for searching. Please upload the file(s) again.")
+
+        with self._lock:
+            index, store = self.index, self.store
+            hashes = [file_hash for file_hash in names if file_hash in self._docs]
+            now = time.time()
+            for file_hash in hashes:
+                self._docs[file_hash]['last_used'] = now
+        if not hashes:
+            return []
+        chunks = search_index(query, index, store, top_k=top_k, doc_names=hashes, query_vector=query_vector, timings=timings, with_vectors=with_vectors)
+
+        for chunk in chunks:
+            file_hash = chunk['doc_name']
+            chunk['doc_name'] = names[file_hash]
+            chunk['chunk_id'] = chunk['chunk_id'].replace(file_hash, names[file_hash], 1)
+        return chunks
+
+    def _maintain(self):
+        # Evicts idle documents. Only documents that can come back from the embedding cache are evicted, and touching
+        # their entries makes them the last ones the cache's LRU eviction would remove.
+        # Removed documents leave dead rows behind; once there are many, the store is rebuilt from the embedding cache.
+        # Documents missing from the cache are embedded again first, and any still missing are left out, to be added
+        # back when a chat needs them
+        with self._write_lock:
+            index, store, docs = self._snapshot()
+            settings = embedding_settings()
+            cutoff = time.time() - IDLE_SECONDS
+            idle = [file_hash for file_hash, details in docs.items() if details['last_used'] < cutoff and cache.touch_chunks(file_hash, settings)]
+            changed = bool(idle)
+            if idle:
+                index, store = remove_documents_from_index(self._copy_index(index), store.copy(), idle)
+                for file_hash in idle:
+                    del docs[file_hash]
+
+            if _needs_compaction(store):
+                for file_hash, details in docs.items():
+                    if not cache.touch_chunks(file_hash, settings):
+                        try:
+                            embed_document(details, notify=print)
+                        except RuntimeError as e:
+                            print(f"Could not re-embed a document for compaction: {e}")
+                            break
+                cached = {file_hash: details for file_hash, details in docs.items() if cache.touch_chunks(file_hash, settings)}
+                index, store = add_documents_to_index(None, ChunkStore(), cached, notify=print) if cached else (None, ChunkStore())
+                docs = {file_hash: details for file_hash, details in cached.items() if file_hash in store.indexed_doc_names()}
+                changed = True
+
+            if changed:
+                self._publish(index, store, docs)
+
+
+@st.cache_resource(show_spinner=False)
+def get_document_store() -> DocumentStore:
+    # One store per process, shared by all sessions, picked up again from disk after a restart
+    return DocumentStore.open(cache.DOCSTORE_DIR)
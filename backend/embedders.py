@@ -0,0 +1,38 @@
+# backend/embedders.py
+
+import os
+
+# Which runtime computes the embeddings:
+#   torch      - the default PyTorch model
+#   torch-int8 - PyTorch with the Linear layers dynamically quantized to int8
+#   onnx       - ONNX Runtime with the exported fp32 model
+#   onnx-int8  - ONNX Runtime with an int8-quantized export (ONNX_INT8_FILE)
+EMBEDDING_BACKEND = os.environ.get("DOCBOT_EMBEDDING_BACKEND", "torch")
+# Local directory with the model files. Without it the model is fetched from the Hugging Face hub by name
+EMBEDDING_MODEL_PATH = os.environ.get("DOCBOT_EMBEDDING_MODEL_PATH") or None
+# Quantized ONNX file inside the model directory. all-MiniLM-L6-v2 ships variants for avx2, avx512, avx512_vnni and arm64
+ONNX_INT8_FILE = os.environ.get("DOCBOT_ONNX_INT8_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+
+EMBEDDING_BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+
+def load_embedder(model_name: str, backend: str | None = None, model_path: str | None = None):
+    # Every backend is wrapped in a SentenceTransformer, so encode() and the multi-process pool work the same for all of them.
+    # sentence_transformers (and with it torch) is only imported here, when a model is actually needed
+    from sentence_transformers import SentenceTransformer
+
+    backend = backend or EMBEDDING_BACKEND
+    model_path = model_path or EMBEDDING_MODEL_PATH or model_name
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}'. Expected one of: {', '.join(EMBEDDING_BACKENDS)}")
+
+    if backend == "onnx":
+        return SentenceTransformer(model_path, device="cpu", backend="onnx")
+    if backend == "onnx-int8":
+        return SentenceTransformer(model_path, device="cpu", backend="onnx", model_kwargs={"file_name": ONNX_INT8_FILE})
+
+    model = SentenceTransformer(model_path, device="cpu")
+    if backend == "torch-int8":
+        import torch
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
@@ -0,0 +1,248 @@
+# backend/indexes.py
+
+import math
+import os
+
+import faiss
+import numpy as np
+
+# Which FAISS index to build. "auto" keeps the exact flat scan for small chats and switches to an
+# approximate index once a chat has more than ANN_THRESHOLD chunks
+INDEX_TYPE = os.environ.get("DOCBOT_INDEX_TYPE", "auto")  # auto, flat, ivf_flat, ivf_pq or hnsw
+AUTO_ANN_INDEX_TYPE = "ivf_flat"
+ANN_THRESHOLD = int(os.environ.get("DOCBOT_ANN_THRESHOLD", 50_000))
+
+# IVF: number of clusters probed per query (more = better recall, slower)
+IVF_NPROBE = int(os.environ.get("DOCBOT_IVF_NPROBE", 16))
+# IVF-PQ: sub-quantizers per vector and bits per code. The dimension must be divisible by PQ_M
+PQ_M = 16
+PQ_NBITS = 8
+# HNSW: graph degree, build-time and query-time beam width
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = int(os.environ.get("DOCBOT_HNSW_EF_SEARCH", 64))
+
+# Searches restricted to some documents only reach the allowed vectors an approximate index happens to visit.
+# Up to this many allowed vectors are scanned exactly instead; larger sets widen nprobe / efSearch by how small
+# a share of the index they are
+EXACT_FILTER_MAX_IDS = int(os.environ.get("DOCBOT_EXACT_FILTER_MAX_IDS", 10_000))
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+# FAISS wants at least this many training points per IVF cluster; streamed builds collect a few more
+MIN_POINTS_PER_CENTROID = 39
+TRAINING_POINTS_PER_CENTROID = 64
+
+
+def resolve_index_type(num_vectors: int, index_type: str | None = None) -> str:
+    index_type = index_type or INDEX_TYPE
+    if index_type == "auto":
+        return AUTO_ANN_INDEX_TYPE if num_vectors > ANN_THRESHOLD else "flat"
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}'. Expected one of: auto, {', '.join(INDEX_TYPES)}")
+    return index_type
+
+
+def _ivf_nlist(num_vectors: int) -> int:
+    # Around 4 * sqrt(n) clusters, but never more than the training data can support
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // MIN_POINTS_PER_CENTROID))
+
+
+def new_faiss_index(dimension: int, num_vectors: int, index_type: str | None = None) -> faiss.Index:
+    # Creates an empty ID-addressable index sized for about num_vectors vectors. The IVF types still need training.
+    # Approximate types fall back to a flat index when there is too little data to train them
+    index_type = resolve_index_type(num_vectors, index_type)
+
+    if index_type == "ivf_pq" and (dimension % PQ_M or num_vectors < 2 ** PQ_NBITS * MIN_POINTS_PER_CENTROID):
+        index_type = "ivf_flat"
+    if index_type in ("ivf_flat", "ivf_pq") and num_vectors < MIN_POINTS_PER_CENTROID * 2:
+        index_type = "flat"
+
+    if index_type == "flat":
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+    if index_type == "hnsw":
+        hnsw = faiss.IndexHNSWFlat(dimension, HNSW_M)
+        hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        return faiss.IndexIDMap2(hnsw)
+
+    # IVF indexes store IDs themselves, so they don't need the ID map wrapper. The direct map lets reconstruct()
+    # look vectors up by ID without modifying an index that others may be searching
+    nlist = _ivf_nlist(num_vectors)
+    quantizer = faiss.IndexFlatL2(dimension)
+    if index_type == "ivf_pq":
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, PQ_M, PQ_NBITS)
+    else:
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index
+
+
+def _training_size(index: faiss.Index, num_vectors: int) -> int:
+    # How many vectors to collect before training an IVF index
+    wanted = index.nlist * TRAINING_POINTS_PER_CENTROID
+    if isinstance(index, faiss.IndexIVFPQ):
+        wanted = max(wanted, 2 ** PQ_NBITS * MIN_POINTS_PER_CENTROID)
+    return min(num_vectors, wanted)
+
+
+class IndexBuilder:
+    """ Adds vectors to an index batch by batch as they are produced, so the full vector matrix never has to be in
+    memory. A new index is created on the first batch; IVF indexes buffer vectors until there are enough to train
+    on, then the buffer is flushed and later batches are added directly."""
+
+    def __init__(self, index: faiss.Index | None, num_vectors: int, index_type: str | None = None):
+        self.index = index
+        self.num_vectors = num_vectors
+        self.index_type = index_type
+        self._created = index is None  # Only an index the builder created itself may be replaced
+        self._buffer = []
+        self._buffered = 0
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        ids = np.ascontiguousarray(ids, dtype='int64')
+        if self.index is None:
+            self.index = new_faiss_index(vectors.shape[1], self.num_vectors, self.index_type)
+        if self.index.is_trained:
+            self.index.add_with_ids(vectors, ids)
+            return
+        self._buffer.append((vectors, ids))
+        self._buffered += len(ids)
+        if self._buffered >= _training_size(self.index, self.num_vectors):
+            self._train_and_flush()
+
+    def _train_and_flush(self):
+        vectors = np.vstack([v for v, _ in self._buffer])
+        ids = np.concatenate([i for _, i in self._buffer])
+        self._buffer, self._buffered = [], 0
+        if self._created and len(ids) < _training_size(self.index, self.num_vectors):
+            # num_vectors is often an estimate, and fewer vectors arrived than the index was sized for. Training
+            # needs enough of them per list, so the index is created again for the actual count: fewer lists, or flat
+            self.index = new_faiss_index(vectors.shape[1], len(ids), self.index_type)
+        if not self.index.is_trained:
+            self.index.train(vectors)
+        self.index.add_with_ids(vectors, ids)
+
+    def finish(self) -> faiss.Index | None:
+        if self._buffer:
+            self._train_and_flush()
+        return self.index
+
+
+def build_faiss_index(vectors: np.ndarray, ids: np.ndarray, index_type: str | None = None) -> faiss.Index:
+    # Builds (and trains, for the IVF types) an ID-addressable index over the vectors in one go
+    builder = IndexBuilder(None, len(vectors), index_type)
+    builder.add(vectors, ids)
+    return builder.finish()
+
+
+def upgrade_index(index: faiss.Index | None, ids: np.ndarray) -> faiss.Index | None:
+    # An index that started flat and grew a few documents at a time is rebuilt (and trained) as the approximate
+    # type once it holds enough vectors for resolve_index_type to pick one. ids are all the IDs it holds
+    if index is None or index_type_of(index) != "flat":
+        return index
+    if index_type_of(new_faiss_index(index.d, index.ntotal)) == "flat":
+        return index
+    ids = np.ascontiguousarray(ids, dtype='int64')
+    return build_faiss_index(index.reconstruct_batch(ids), ids)
+
+
+def base_index(index: faiss.Index) -> faiss.Index:
+    # The index doing the actual search, with the ID map wrapper peeled off
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def index_type_of(index: faiss.Index) -> str:
+    base = base_index(index)
+    if isinstance(base, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(base, faiss.IndexIVF):
+        return "ivf_flat"
+    if isinstance(base, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def search_parameters(index: faiss.Index, selector: faiss.IDSelector | None = None, widen: float = 1.0) -> faiss.SearchParameters:
+    # Search-time knobs for the index type, optionally restricted to the IDs accepted by selector.
+    # widen multiplies nprobe / efSearch, for filters that leave only part of the index to find hits in
+    kwargs = {"sel": selector} if selector is not None else {}
+    index_type = index_type_of(index)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        base = base_index(index)
+        return faiss.SearchParametersIVF(nprobe=min(base.nlist, int(IVF_NPROBE * widen)), **kwargs)
+    if index_type == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=max(HNSW_EF_SEARCH, min(index.ntotal, int(HNSW_EF_SEARCH * widen))), **kwargs)
+    return faiss.SearchParameters(**kwargs)
+
+
+def filtered_search(index: faiss.Index, query_vector: np.ndarray, k: int, allowed_ids: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    # index.search, optionally restricted to allowed_ids, that returns the k nearest allowed vectors on every index type.
+    # A flat index filters inside its exact scan. Approximate ones only visit some of the vectors, which may hold
+    # few of the allowed ones, so a small allowed set is scanned exactly and a large one gets a wider search
+    if allowed_ids is None:
+        return index.search(query_vector, k, params=search_parameters(index))
+    allowed_ids = np.ascontiguousarray(allowed_ids, dtype='int64')
+    if index_type_of(index) != "flat" and allowed_ids.size <= EXACT_FILTER_MAX_IDS:
+        vectors = reconstruct(index, allowed_ids)
+        if vectors is not None:
+            exact = faiss.IndexFlatL2(vectors.shape[1])
+            exact.add(vectors)
+            distances, positions = exact.search(query_vector, min(k, allowed_ids.size))
+            return distances, np.where(positions >= 0, allowed_ids[np.maximum(positions, 0)], -1)
+    widen = index.ntotal / max(allowed_ids.size, 1)
+    return index.search(query_vector, k, params=search_parameters(index, faiss.IDSelectorBatch(allowed_ids), widen))
+
+
+def copy_index(index: faiss.Index | None, path: str | None = None) -> faiss.Index | None:
+    # An independent copy, to add to or remove from while searches keep using the original. An index memory-mapped
+    # from path is read into memory again, since FAISS can't clone every memory-mapped index type
+    if index is None:
+        return None
+    try:
+        return faiss.clone_index(index)
+    except RuntimeError:
+        if path is None:
+            raise
+        return faiss.read_index(path)
+
+
+def write_index(index: faiss.Index, path: str):
+    faiss.write_index(index, path)
+
+
+def read_index(path: str) -> faiss.Index:
+    # Opens a saved index memory-mapped read-only, so its vectors are paged in from disk as searches touch them
+    # instead of being loaded up front
+    try:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+    except RuntimeError:
+        # Not every index type can be memory-mapped
+        return faiss.read_index(path)
+
+
+def reconstruct(index: faiss.Index, ids) -> np.ndarray | None:
+    # The stored vectors of the given IDs, or None when the index can't give them back (e.g. an IVF index without
+    # a direct map). IVF-PQ only keeps codes, so its vectors come back approximate
+    ids = np.ascontiguousarray(ids, dtype='int64')
+    try:
+        return index.reconstruct_batch(ids)
+    except RuntimeError:
+        return None
+
+
+def remove_ids(index: faiss.Index, ids: np.ndarray, remaining_ids: np.ndarray) -> faiss.Index | None:
+    # Removes vectors from the index and returns the index to keep using. HNSW graphs can't drop nodes,
+    # so that index type is rebuilt from the vectors it still stores
+    ids = np.ascontiguousarray(ids, dtype='int64')
+    if index_type_of(index) != "hnsw":
+        index.remove_ids(ids)
+        return index
+
+    remaining_ids = np.ascontiguousarray(remaining_ids, dtype='int64')
+    if remaining_ids.size == 0:
+        return None
+    vectors = index.reconstruct_batch(remaining_ids)
+    return build_faiss_index(vectors, remaining_ids, "hnsw")
+
@@ -1,70 +1,310 @@
 # backend/ingest.py
 
-import fitz  # PyMuPDF is needed to open the PDF and render pages for Tesseract to work on it
-from PIL import Image
-import pytesseract
-import io
+# PyMuPDF (fitz, to open the PDF and render pages for Tesseract), PIL and pytesseract are imported where they are
+# used, so the app starts without loading them
+import numpy as np
 import streamlit as st
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+import atexit
+import multiprocessing
 import os
+import threading
+import time
+from backend import metrics
 
-def extract_metadata_and_text(path: str) -> tuple[list[dict], dict]:
-    """ This takes the PDF and extracts the metadata as well as the text and returns a tuple which has the list of dictionaries containing the metadata such as title 
-    among other things"""
-    page_data = []
+OCR_DPI = 300
+# Scans are rendered just sharp enough for their text: a quick low resolution render estimates the height of the text
+# lines, and the DPI is chosen so lines come out about OCR_TARGET_LINE_PX pixels tall, between OCR_MIN_DPI and OCR_DPI.
+# Big pages are also kept under OCR_MAX_PIXELS. Set DOCBOT_OCR_ADAPTIVE_DPI=0 to always render at OCR_DPI
+OCR_ADAPTIVE_DPI = os.environ.get("DOCBOT_OCR_ADAPTIVE_DPI", "1") != "0"
+OCR_MIN_DPI = 150
+OCR_PROBE_DPI = 72
+OCR_TARGET_LINE_PX = 40
+OCR_MAX_PIXELS = 40_000_000
+# Blank margins are cropped off before OCR, so Tesseract doesn't scan empty paper
+OCR_CROP_MARGINS = os.environ.get("DOCBOT_OCR_CROP_MARGINS", "1") != "0"
+OCR_CROP_PADDING_PX = 16
+# Gray levels below this count as ink for the line height estimate and the margin crop
+OCR_INK_THRESHOLD = 160
+# Tesseract language(s), e.g. "eng" or "eng+deu"
+OCR_LANG = os.environ.get("DOCBOT_OCR_LANG", "eng")
+# Number of worker processes used for OCR. 1 keeps the old page-by-page behaviour
+OCR_WORKERS = int(os.environ.get("DOCBOT_OCR_WORKERS", os.cpu_count() or 1))
+# Pages handed to a worker per task, so every worker doesn't reopen the PDF for each page
+OCR_PAGES_PER_TASK = 4
+# OCR tasks kept queued per worker ahead of whoever consumes the pages. Reading stops there until the
+# consumer (splitting, embedding) catches up, so a huge scan never piles up in memory
+OCR_READ_AHEAD_TASKS = 2
+# A page's own text layer is trusted when it has at least this many visible characters
+# and most of them are readable (scanned PDFs often carry a few junk glyphs instead of real text)
+MIN_TEXT_LAYER_CHARS = 50
+MIN_TEXT_LAYER_READABLE_RATIO = 0.8
+
+
+def _usable_text_layer(text: str) -> bool:
+    # Decides whether the native text of a page is good enough to skip OCR for it
+    visible = [c for c in text if not c.isspace()]
+    if len(visible) < MIN_TEXT_LAYER_CHARS:
+        return False
+    readable = sum(1 for c in visible if c.isprintable() and c != "\ufffd")
+    return readable / len(visible) >= MIN_TEXT_LAYER_READABLE_RATIO
+
+
+def ocr_settings() -> dict:
+    # Everything that changes the extracted text. Used as part of the cache key for OCR results
+    return {
+        "dpi": OCR_DPI,
+        "adaptive_dpi": OCR_ADAPTIVE_DPI and (OCR_MIN_DPI, OCR_TARGET_LINE_PX, OCR_MAX_PIXELS),
+        "crop_margins": OCR_CROP_MARGINS,
+        "lang": OCR_LANG,
+        "min_text_layer_chars": MIN_TEXT_LAYER_CHARS,
+        "min_text_layer_readable_ratio": MIN_TEXT_LAYER_READABLE_RATIO,
+    }
+
+
+def _render_gray(page, dpi: int):
+    # Renders straight to 8-bit grayscale and wraps the pixel buffer as it is, no PNG encode / decode in between.
+    # Returns a PIL image
+    import fitz
+    from PIL import Image
+
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+    return Image.frombuffer("L", (pix.width, pix.height), pix.samples, "raw", "L", pix.stride, 1)
+
+
+def _line_height_points(page) -> float | None:
+    # Median height of the text lines on the page, in points, from the rows with ink in a low resolution render.
+    # None when no text-like lines are found (blank page, only pictures)
+    ink = np.asarray(_render_gray(page, OCR_PROBE_DPI)) < OCR_INK_THRESHOLD
+    rows = np.concatenate(([False], ink.any(axis=1), [False]))
+    edges = np.flatnonzero(rows[1:] != rows[:-1])
+    heights = edges[1::2] - edges[::2]
+    # Runs of a pixel or two are rules and specks, very tall ones are pictures or dense blocks
+    heights = heights[(heights >= 2) & (heights < ink.shape[0] / 8)]
+    if not heights.size:
+        return None
+    return float(np.median(heights)) * 72 / OCR_PROBE_DPI
+
+
+def choose_dpi(page) -> int:
+    # The DPI a scanned page is rendered at for OCR
+    if not OCR_ADAPTIVE_DPI:
+        return OCR_DPI
+    dpi = OCR_DPI
+    line_height = _line_height_points(page)
+    if line_height:
+        dpi = OCR_TARGET_LINE_PX * 72 / line_height
+    area_in = (page.rect.width / 72) * (page.rect.height / 72)
+    if area_in > 0:
+        dpi = min(dpi, (OCR_MAX_PIXELS / area_in) ** 0.5)
+    return int(max(OCR_MIN_DPI, min(OCR_DPI, dpi)))
+
+
+def _crop_margins(img):
+    # Cuts the blank border around the ink, keeping a little padding
+    bbox = img.point(lambda v: 255 if v < OCR_INK_THRESHOLD else 0).getbbox()
+    if bbox is None:
+        return img
+    left, top, right, bottom = bbox
+    return img.crop((max(0, left - OCR_CROP_PADDING_PX), max(0, top - OCR_CROP_PADDING_PX),
+                     min(img.width, right + OCR_CROP_PADDING_PX), min(img.height, bottom + OCR_CROP_PADDING_PX)))
+
+
+def _ocr_page(page, dpi: int | None = None, timings: dict | None = None, crop: bool = OCR_CROP_MARGINS) -> str:
+    # Render the page as a grayscale image, at a fixed DPI when one is given and at choose_dpi() otherwise
+    start = time.perf_counter()
+    img = _render_gray(page, dpi or choose_dpi(page))
+    if crop:
+        img = _crop_margins(img)
+    rendered = time.perf_counter()
+
+    # Use Tesseract to extract text from the image
+    import pytesseract
+    text = pytesseract.image_to_string(img, lang=OCR_LANG)
+    if timings is not None:
+        timings["ingest_render"] = rendered - start
+        timings["ingest_ocr"] = time.perf_counter() - rendered
+    return text
+
+
+def _ocr_page_range(path: str, page_numbers: list[int], dpi: int | None = None) -> list[tuple[int, str, str | None, dict]]:
+    # Runs inside a worker process. Every worker opens the PDF itself since fitz documents can't be pickled.
+    # Returns (page_index, text, error, timings) for every page so one bad page doesn't take the others down with it.
+    # The render / OCR timings travel back with the results, since metrics recorded in a worker would stay there
+    import fitz
+    doc = fitz.open(path)
+    try:
+        return list(_ocr_pages_serial(doc, page_numbers, dpi))
+    finally:
+        doc.close()
+
+
+def _ocr_pages_serial(doc, page_numbers: list[int], dpi: int | None = None):
+    for page_num in page_numbers:
+        timings = {}
+        try:
+            yield page_num, _ocr_page(doc[page_num], dpi, timings), None, timings
+        except Exception as ocr_e:
+            yield page_num, "", str(ocr_e), timings
+
+
+_ocr_pools = {}
+_ocr_pools_lock = threading.Lock()
+
+
+def _get_ocr_pool(workers: int) -> ProcessPoolExecutor:
+    # One long-lived pool per worker count, shared by all documents and stopped at exit. Workers are spawned, not
+    # forked: ingest runs on background threads of the Streamlit server, and forking a multi-threaded process can
+    # leave the child deadlocked on a lock some other thread held
+    with _ocr_pools_lock:
+        pool = _ocr_pools.get(workers)
+        if pool is None:
+            pool = _ocr_pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            atexit.register(pool.shutdown, wait=False, cancel_futures=True)
+        return pool
+
+
+def _drop_ocr_pool(workers: int):
+    # A pool whose worker died can't run anything anymore; the next document starts a new one
+    with _ocr_pools_lock:
+        _ocr_pools.pop(workers, None)
+
+
+def _document_metadata(doc) -> dict:
     doc_metadata = {
         "author": "Unknown",
         "creation_date": None,
         "title": "Unknown"
     }
-    doc_name = os.path.basename(path)
 
+    # Extract Document-Level Metadata such as author, date and title
+    meta = doc.metadata
+    doc_metadata["author"] = meta.get('author', 'Unknown').strip() or "Unknown"
+    doc_metadata["title"] = meta.get('title', 'Unknown').strip() or "Unknown"
+
+    # Parse creation date
+    creation_date_str = meta.get('creationDate', '')
+    if creation_date_str and creation_date_str.startswith('D:'):
+        try:
+            date_str = creation_date_str[2:16]
+            doc_metadata["creation_date"] = datetime.strptime(date_str, '%Y%m%d%H%M%S')
+        except (ValueError, IndexError):
+            doc_metadata["creation_date"] = None
+    return doc_metadata
+
+
+def read_document_metadata(path: str) -> tuple[dict, int]:
+    # Author, title and creation date of a PDF plus its page count, without touching the pages themselves
+    import fitz
+    doc = fitz.open(path)
     try:
-        doc = fitz.open(path)
-        
-        # Extract Document-Level Metadata such as author, date and title
-        meta = doc.metadata
-        doc_metadata["author"] = meta.get('author', 'Unknown').strip() or "Unknown"
-        doc_metadata["title"] = meta.get('title', 'Unknown').strip() or "Unknown"
-        
-        # Parse creation date
-        creation_date_str = meta.get('creationDate', '')
-        if creation_date_str and creation_date_str.startswith('D:'):
-            try:
-                date_str = creation_date_str[2:16]
-                doc_metadata["creation_date"] = datetime.strptime(date_str, '%Y%m%d%H%M%S')
-            except (ValueError, IndexError):
-                doc_metadata["creation_date"] = None
-        
-        st.toast(f"Starting OCR for all pages of '{doc_name}'...")
-
-        # Applying OCR on the pages.
-        for page_num, page in enumerate(doc):
-            text = "" # Takes the text from each page and then for every page, resets it
+        return _document_metadata(doc), doc.page_count
+    finally:
+        doc.close()
+
+
+def iter_pages(path: str, workers: int | None = None, progress=None, notify=None):
+    """ Yields the page entries ({"text", "page_number", "source"}) of a PDF in page order while it is being read,
+    so the caller can split and embed the first pages while later ones are still being OCR'd. Pages with a usable
+    text layer are read directly, the rest go through OCR (spread over a process pool when there is more than one
+    worker). Only a few OCR tasks are kept in flight ahead of the caller, so memory stays flat however long the
+    document is. progress(pages_done, pages_total) is called as pages finish; notify replaces st.toast for status
+    messages. Errors opening or reading the PDF are raised."""
+    notify = notify or st.toast
+    workers = OCR_WORKERS if workers is None else workers
+    doc_name = os.path.basename(path)
+    read_ahead = max(1, workers) * OCR_READ_AHEAD_TASKS
+    pending = deque()  # ("text" | "ocr", results or a future of an OCR batch), in page order
+    batch = []
+    counts = {"text": 0, "ocr": 0}
+    pages_done = 0
+    executor = None
+    start_time = time.perf_counter()
+
+    import fitz
+    doc = fitz.open(path)
+    page_count = doc.page_count
+
+    def flush_batch():
+        nonlocal batch
+        if batch:
+            pending.append(("ocr", executor.submit(_ocr_page_range, path, batch)))
+            batch = []
+
+    def emit(source, results):
+        nonlocal pages_done
+        if not isinstance(results, list):
             try:
-                # Render the page as a high-resolution image
-                pix = page.get_pixmap(dpi=300) 
-                img = Image.open(io.BytesIO(pix.tobytes("png")))
-                
-                # Use Tesseract to extract text from the image
-                text = pytesseract.image_to_string(img)
-            except Exception as ocr_e:
+                results = results.result()
+            except BrokenProcessPool:
+                _drop_ocr_pool(workers)
+                raise
+        for page_num, text, error, timings in results:
+            for stage, seconds in timings.items():
+                metrics.observe(stage, seconds)
+            pages_done += 1
+            counts[source] += 1
+            if progress:
+                progress(pages_done, page_count)
+            if error:
                 # Toast to show unsuccessful OCR try on the page and continue
-                st.toast(f"⚠️ OCR failed on page {page_num + 1}: {ocr_e}")
-                text = ""
-            
-            # Add the extracted text to our data if any was found
+                notify(f"⚠️ OCR failed on page {page_num + 1}: {error}")
+                continue
             if text.strip():
-                page_data.append({
-                    "text": text.strip(),
-                    "page_number": page_num + 1
-                })
-                
+                yield {"text": text.strip(), "page_number": page_num + 1, "source": source}
+
+    try:
+        for page_num in range(page_count):
+            # Born-digital pages already carry their text, which is far cheaper than rasterizing and OCR'ing them
+            with metrics.span("ingest_text_layer"):
+                try:
+                    text = doc[page_num].get_text()
+                except Exception:
+                    text = ""
+            if _usable_text_layer(text):
+                flush_batch()
+                pending.append(("text", [(page_num, text, None, {})]))
+            elif workers > 1:
+                executor = executor or _get_ocr_pool(workers)
+                batch.append(page_num)
+                if len(batch) == OCR_PAGES_PER_TASK:
+                    flush_batch()
+            else:
+                pending.append(("ocr", list(_ocr_pages_serial(doc, [page_num]))))
+
+            # Backpressure: hand finished pages out before reading further ahead
+            while len(pending) > read_ahead:
+                yield from emit(*pending.popleft())
+
+        flush_batch()
+        while pending:
+            yield from emit(*pending.popleft())
+    finally:
+        # The pool outlives the document; OCR tasks nobody will read anymore (the caller stopped early) are dropped
+        for source, results in pending:
+            if source == "ocr" and not isinstance(results, list):
+                results.cancel()
         doc.close()
-        st.toast(f"✅ OCR complete. Extracted text from {len(page_data)} pages of '{doc_name}'.")
-        
+
+    if counts["ocr"]:
+        elapsed = time.perf_counter() - start_time
+        pages_per_sec = counts["ocr"] / elapsed if elapsed > 0 else 0.0
+        print(f"OCR of '{doc_name}': {counts['ocr']} pages in {elapsed:.1f}s ({pages_per_sec:.2f} pages/sec, {workers} worker(s))")
+    notify(f"✅ Extracted text from {page_count} pages of '{doc_name}' ({counts['text']} from the text layer, {counts['ocr']} via OCR).")
+
+
+def extract_metadata_and_text(path: str, workers: int | None = None, progress=None, notify=None) -> tuple[list[dict], dict]:
+    """ This takes the PDF and extracts the metadata as well as the text and returns a tuple which has the list of dictionaries containing the metadata such as title
+    among other things. The pages come from iter_pages, collected into one list; ingesting large documents should
+    consume iter_pages directly instead."""
+    notify = notify or st.toast
+    try:
+        doc_metadata, _ = read_document_metadata(path)
+        page_data = list(iter_pages(path, workers, progress, notify))
     except Exception as e:
-        st.toast(f"❌ Error processing PDF '{doc_name}': {e}")
+        notify(f"❌ Error processing PDF '{os.path.basename(path)}': {e}")
         return [], {}
-
     return page_data, doc_metadata
@@ -0,0 +1,179 @@
+# backend/jobs.py
+
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from backend.cache import load_pages, open_pages_writer
+from backend.docstore import DocumentStore, get_document_store
+from backend.ingest import iter_pages, ocr_settings, read_document_metadata
+from backend.vectorstore import embed_document
+
+# Uploads are OCR'd and indexed on these background threads instead of inside the Streamlit callback.
+# OCR and embedding already use several cores each, so one job at a time is usually enough
+INGEST_WORKERS = int(os.environ.get("DOCBOT_INGEST_WORKERS", 1))
+# Uploads are copied to disk in pieces of this size instead of being read into one bytes object
+SPOOL_CHUNK_BYTES = 1024 * 1024
+
+
+def spool_upload(file_obj) -> tuple[str, str]:
+    # Copies an uploaded file to a temporary PDF piece by piece, hashing it on the way.
+    # Returns (path, content hash); whoever gets the path deletes the file
+    digest = hashlib.sha256()
+    file_obj.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
+        while True:
+            piece = file_obj.read(SPOOL_CHUNK_BYTES)
+            if not piece:
+                break
+            digest.update(piece)
+            tmp.write(piece)
+    return tmp.name, digest.hexdigest()
+
+
+class IngestJob:
+    """ One batch of uploads for one chat. The worker thread writes the progress fields, the page reads them.
+    files maps the name of each upload to its spooled (path, content hash); the job deletes the files when it's done.
+    Every document that made it into the shared document store ends up in doc_details (by content hash) and in
+    names (file name -> content hash), ready to be added to the chat."""
+
+    def __init__(self, owner: tuple[str, str], files: dict[str, tuple[str, str]]):
+        self.id = uuid.uuid4().hex
+        self.owner = owner  # (session id, chat name)
+        self.files = dict(files)
+        self.documents = {
+            name: {"status": "queued", "pages_done": 0, "pages_total": 0, "chunks_embedded": 0, "chunks_total": 0}
+            for name in self.files
+        }
+        self.status = "queued"  # queued, running, done or failed
+        self.messages = []
+        self.error = None
+        self.doc_details = {}
+        self.names = {}
+        self.submitted_at = time.time()
+
+    @property
+    def chat_name(self) -> str:
+        return self.owner[1]
+
+    def notify(self, message: str):
+        self.messages.append(message)
+
+    def remove_files(self):
+        for path, _ in self.files.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _stream_pages(path: str, file_hash: str, metadata: dict, progress, notify):
+    # Pages straight from the PDF as they are read or OCR'd, written to the OCR cache on the way through.
+    # The cache entry only becomes visible once the whole document was read
+    writer = open_pages_writer(file_hash, ocr_settings())
+    committed = False
+    try:
+        for page in iter_pages(path, progress=progress, notify=notify):
+            if writer is not None:
+                writer.append(page)
+            yield page
+        if writer is not None:
+            writer.commit(metadata)
+            committed = True
+    except Exception as e:
+        notify(f"❌ Error processing PDF '{os.path.basename(path)}': {e}")
+        raise
+    finally:
+        if writer is not None and not committed:
+            writer.abort()
+
+
+class IngestQueue:
+    """ Runs IngestJobs on a thread pool. Every document goes into the process-wide DocumentStore, where a file that
+    any chat or session added before is found by its content hash and not read or embedded again. Chats keep
+    answering from the documents they already have until the page adds the job's documents to them."""
+
+    def __init__(self, docstore: DocumentStore, workers: int = INGEST_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        self.docstore = docstore
+
+    def submit(self, job: IngestJob) -> IngestJob:
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job: IngestJob):
+        job.status = "running"
+        try:
+            for name in job.files:
+                self._ingest(job, name)
+            if not job.names:
+                raise RuntimeError("No text could be extracted from the uploaded files.")
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.remove_files()
+
+    def _upload_details(self, job: IngestJob, name: str) -> dict:
+        # Details of a new upload. A file read before comes from the OCR cache; otherwise its pages are a
+        # generator that reads the PDF while the chunks are being embedded
+        path, file_hash = job.files[name]
+        progress = job.documents[name]
+        cached = load_pages(file_hash, ocr_settings())
+        if cached is not None:
+            pages, metadata = cached
+            progress["pages_done"] = progress["pages_total"] = len(pages)
+            return {'pages': pages, 'metadata': metadata, 'hash': file_hash}
+
+        def on_pages(done, total, progress=progress):
+            progress["pages_done"], progress["pages_total"] = done, total
+        metadata, page_count = read_document_metadata(path)
+        progress["pages_total"] = page_count
+        pages = _stream_pages(path, file_hash, metadata, on_pages, job.notify)
+        return {'pages': pages, 'page_count': page_count, 'metadata': metadata, 'hash': file_hash}
+
+    def _ingest(self, job: IngestJob, name: str):
+        progress = job.documents[name]
+
+        def on_chunks(done, total):
+            progress["chunks_embedded"], progress["chunks_total"] = done, total
+        try:
+            file_hash = job.files[name][1]
+            details = self.docstore.document(file_hash)
+            if details is None:
+                details = self._upload_details(job, name)
+            if 'page_count' in details:
+                # Read, split and embed in one pass; afterwards the pages are kept as their OCR cache entry
+                # rather than the generator that was just used up
+                progress["status"] = "reading and embedding"
+                if embed_document(details, on_chunks, job.notify) is False:
+                    progress["status"] = "failed"
+                    return
+                cached = load_pages(file_hash, ocr_settings())
+                if cached is None:
+                    # The embeddings were cached but the pages weren't (or the cache can't be written): the pages
+                    # are still read, which also writes their OCR cache entry, so the document viewer has them
+                    pages = list(details['pages'])
+                    cached = load_pages(file_hash, ocr_settings()) or (pages, details['metadata'])
+                details = {'pages': cached[0], 'metadata': details['metadata'], 'hash': file_hash}
+            progress["status"] = "indexing"
+            if not self.docstore.add(details, on_chunks, job.notify):
+                progress["status"] = "failed"
+                return
+        except Exception as e:
+            job.notify(f"❌ Error processing PDF '{name}': {e}")
+            progress["status"] = "failed"
+            return
+        job.doc_details[file_hash] = details
+        job.names[name] = file_hash
+        progress["status"] = "done"
+
+
+@st.cache_resource(show_spinner=False)
+def get_ingest_queue() -> IngestQueue:
+    # One queue per process, shared by all sessions
+    return IngestQueue(get_document_store())
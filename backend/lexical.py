@@ -0,0 +1,169 @@
+# backend/lexical.py
+
+import json
+import math
+import os
+import re
+from array import array
+
+import numpy as np
+
+# Tokens are runs of letters and digits in any script ("größe", "café"). They keep inner dashes, dots and slashes,
+# so invoice numbers, clause IDs and dates ("INV-2023-0042", "4.2.1", "12/03/2024") stay single terms that an exact
+# query can hit
+TOKEN_PATTERN = re.compile(r"[^\W_]+(?:[-./][^\W_]+)*")
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Terms found in more than this share of the rows ("the", "what") add next to nothing to the ranking but have the
+# longest posting lists, so queries skip them. A query made only of such terms gets no lexical hits and is left to
+# the dense ranking. Posting lists up to MIN_DF_CUTOFF rows are always scored, so small stores are searched in full
+MAX_DF_RATIO = 0.3
+MIN_DF_CUTOFF = 1000
+
+VOCABULARY_FILE = "bm25_terms.json"
+POSTINGS_FILE = "bm25_postings.npz"
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """ Inverted index over chunk texts, scored with BM25. Rows use the same IDs as the FAISS index.
+    Each term maps to an ID array and a term-frequency array; since IDs only grow, adding rows just appends
+    to the postings. A query only touches the postings of its own terms."""
+
+    def __init__(self):
+        self._postings: dict[str, tuple[array, array]] = {}
+        self._lengths = array('i')  # Token count per row
+        self._alive = bytearray()   # 1 for rows that were added and not removed
+        self._live_rows = 0
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return self._live_rows
+
+    def copy(self) -> "BM25Index":
+        other = BM25Index()
+        other._postings = {token: (array('q', ids), array('i', tfs)) for token, (ids, tfs) in self._postings.items()}
+        other._lengths = array('i', self._lengths)
+        other._alive = bytearray(self._alive)
+        other._live_rows = self._live_rows
+        other._total_length = self._total_length
+        return other
+
+    def add(self, row: int, text: str):
+        # Rows must be added in increasing ID order
+        tokens = tokenize(text)
+        while len(self._lengths) < row:
+            self._lengths.append(0)
+            self._alive.append(0)
+        self._lengths.append(len(tokens))
+        self._alive.append(1)
+        self._live_rows += 1
+        self._total_length += len(tokens)
+
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = (array('q'), array('i'))
+            postings[0].append(row)
+            postings[1].append(count)
+
+    def remove(self, rows):
+        # Drops rows from every posting list. Removing documents is rare, so a pass over the postings is fine
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.size == 0:
+            return
+        for row in rows:
+            if 0 <= row < len(self._alive) and self._alive[row]:
+                self._total_length -= self._lengths[row]
+                self._alive[row] = 0
+                self._live_rows -= 1
+        for token in list(self._postings):
+            ids, tfs = self._postings[token]
+            ids_np = np.frombuffer(ids, dtype=np.int64)
+            keep = ~np.isin(ids_np, rows)
+            if keep.all():
+                continue
+            if not keep.any():
+                del self._postings[token]
+                continue
+            self._postings[token] = (array('q', ids_np[keep].tobytes()), array('i', np.frombuffer(tfs, dtype=np.int32)[keep].tobytes()))
+
+    def search(self, query: str, top_k: int = 10, allowed_mask: np.ndarray | None = None) -> list[int]:
+        # Returns up to top_k row IDs ranked by BM25, optionally restricted to the rows where allowed_mask is True
+        if not self._live_rows:
+            return []
+        avg_length = self._total_length / self._live_rows
+        lengths = np.frombuffer(self._lengths, dtype=np.int32)
+
+        max_df = max(MAX_DF_RATIO * self._live_rows, MIN_DF_CUTOFF)
+        terms = [self._postings[token] for token in set(tokenize(query)) if token in self._postings]
+        terms = [postings for postings in terms if len(postings[0]) <= max_df]
+
+        all_ids, all_scores = [], []
+        for postings in terms:
+            ids = np.frombuffer(postings[0], dtype=np.int64)
+            tfs = np.frombuffer(postings[1], dtype=np.int32).astype(np.float32)
+            if allowed_mask is not None:
+                keep = allowed_mask[ids]
+                ids, tfs = ids[keep], tfs[keep]
+                if not ids.size:
+                    continue
+            df = len(postings[0])
+            idf = math.log(1 + (self._live_rows - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[ids] / avg_length)
+            all_ids.append(ids)
+            all_scores.append(idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+
+        if not all_ids:
+            return []
+        ids, inverse = np.unique(np.concatenate(all_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+        if len(ids) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            best = np.arange(len(ids))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [int(i) for i in ids[best]]
+
+    # Saved and loaded as part of a ChunkStore snapshot
+
+    def files(self) -> dict:
+        terms = list(self._postings)
+
+        def write_terms(path):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"terms": terms, "live_rows": self._live_rows, "total_length": self._total_length}, f)
+
+        def write_postings(path):
+            sizes = np.array([len(self._postings[t][0]) for t in terms], dtype=np.int64)
+            ids = np.concatenate([np.frombuffer(self._postings[t][0], dtype=np.int64) for t in terms]) if terms else np.empty(0, np.int64)
+            tfs = np.concatenate([np.frombuffer(self._postings[t][1], dtype=np.int32) for t in terms]) if terms else np.empty(0, np.int32)
+            with open(path, "wb") as f:
+                np.savez(f, sizes=sizes, ids=ids, tfs=tfs, lengths=np.frombuffer(self._lengths, dtype=np.int32),
+                         alive=np.frombuffer(self._alive, dtype=np.uint8))
+
+        return {VOCABULARY_FILE: write_terms, POSTINGS_FILE: write_postings}
+
+    @classmethod
+    def load(cls, directory: str) -> "BM25Index":
+        index = cls()
+        with open(os.path.join(directory, VOCABULARY_FILE), encoding="utf-8") as f:
+            data = json.load(f)
+        index._live_rows = data["live_rows"]
+        index._total_length = data["total_length"]
+        with np.load(os.path.join(directory, POSTINGS_FILE)) as postings:
+            ends = np.cumsum(postings["sizes"])
+            ids, tfs = postings["ids"], postings["tfs"]
+            index._lengths = array('i', postings["lengths"].astype(np.int32).tobytes())
+            index._alive = bytearray(postings["alive"].astype(np.uint8).tobytes())
+        start = 0
+        for term, end in zip(data["terms"], ends):
+            index._postings[term] = (array('q', ids[start:end].astype(np.int64).tobytes()), array('i', tfs[start:end].astype(np.int32).tobytes()))
+            start = end
+        return index
@@ -0,0 +1,136 @@
+# backend/metrics.py
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stage timings are collected into per-stage histograms for the whole process. Set DOCBOT_METRICS_PORT to serve them
+# in the Prometheus text format at /metrics, and/or DOCBOT_METRICS_LOG_INTERVAL (seconds) to print a summary now and then
+METRICS_PORT = int(os.environ.get("DOCBOT_METRICS_PORT", 0))
+METRICS_HOST = os.environ.get("DOCBOT_METRICS_HOST", "127.0.0.1")
+METRICS_LOG_INTERVAL = float(os.environ.get("DOCBOT_METRICS_LOG_INTERVAL", 0))
+# Histogram bucket upper bounds in seconds, from sub-millisecond lookups up to OCR of a long document
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one counts everything above the largest bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket the q-quantile falls into
+        wanted, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return float("inf")
+
+
+_histograms: dict[str, Histogram] = {}
+_lock = threading.Lock()
+
+
+def observe(stage: str, seconds: float):
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+
+@contextmanager
+def span(stage: str, timings: dict | None = None):
+    # Times the block into the stage's histogram and, when a dict is passed, adds the seconds to timings[stage]
+    # so a caller can show the breakdown of one request
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(stage, elapsed)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+def render_prometheus() -> str:
+    lines = [
+        "# HELP docbot_stage_seconds Time spent in each stage of the query and ingest pipelines.",
+        "# TYPE docbot_stage_seconds histogram",
+    ]
+    with _lock:
+        for stage in sorted(_histograms):
+            histogram = _histograms[stage]
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'docbot_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'docbot_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'docbot_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'docbot_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> str:
+    with _lock:
+        return "\n".join(
+            f"{stage}: n={h.count} mean={h.sum / h.count * 1000:.1f}ms p50<={h.quantile(0.5) * 1000:g}ms p95<={h.quantile(0.95) * 1000:g}ms"
+            for stage, h in sorted(_histograms.items()) if h.count
+        )
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would otherwise flood the app's log
+        pass
+
+
+def _log_periodically(interval: float):
+    while True:
+        time.sleep(interval)
+        text = summary()
+        if text:
+            print(f"Stage timings:\n{text}")
+
+
+_started = False
+
+
+def start_exporters():
+    # Starts the /metrics endpoint and the periodic log, as configured, once per process
+    global _started
+    with _lock:
+        if _started:
+            return
+        _started = True
+    if METRICS_PORT:
+        try:
+            server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _MetricsHandler)
+        except OSError as e:
+            print(f"Could not start the metrics endpoint on port {METRICS_PORT}: {e}")
+        else:
+            threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    if METRICS_LOG_INTERVAL > 0:
+        threading.Thread(target=_log_periodically, args=(METRICS_LOG_INTERVAL,), name="metrics-log", daemon=True).start()
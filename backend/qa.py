@@ -1,29 +1,148 @@
-from groq import Groq
 import os
+import time
+import numpy as np
 import streamlit as st
+from backend import metrics
 
-# It's recommended to set the API key via environment variables
-# For Streamlit sharing, you would set this in the secrets manager
-try:
-    # This will read the secret you set in the Streamlit Community Cloud settings
-    client = Groq(api_key=st.secrets["GROQ_API_KEY"])
-except Exception:
-    # Fallback for local development if you use a .env file
+# Optional override of the API endpoint, e.g. to point the client at a local fake completion server
+GROQ_BASE_URL = os.environ.get("GROQ_BASE_URL") or None
+
+
+@st.cache_resource(show_spinner=False)
+def _create_groq_client():
+    # Created on the first question and shared by all sessions. Failures raise, so they are not cached and the next call retries
+    from groq import Groq
+
+    # It's recommended to set the API key via environment variables
+    # For Streamlit sharing, you would set this in the secrets manager
     try:
+        # This will read the secret you set in the Streamlit Community Cloud settings
+        return Groq(api_key=st.secrets["GROQ_API_KEY"], base_url=GROQ_BASE_URL)
+    except Exception:
+        # Fallback for local development if you use a .env file
         from dotenv import load_dotenv
         load_dotenv()
-        client = Groq(api_key=os.environ.get("GROQ_API_KEY"))
+        return Groq(api_key=os.environ.get("GROQ_API_KEY"), base_url=GROQ_BASE_URL)
+
+
+def get_groq_client():
+    try:
+        return _create_groq_client()
     except Exception as e:
         st.error(f"Groq API key not found. Please set it in your Streamlit secrets or a local .env file. Error: {e}")
-        client = None
+        return None
 
 
 model_name = "llama3-8b-8192"
 
-def ask_groq(query, context=None):
-    if not query:
-        return "⚠️ No query provided."
+# Retrieved chunks are packed into at most this many prompt tokens (estimated at CHARS_PER_TOKEN characters per
+# token, close enough for English text with the Llama 3 tokenizer). The search returns CONTEXT_CANDIDATES chunks
+# to choose from. The budget stays below the prompt the app used to send, the top BASELINE_CHUNKS chunks pasted
+# verbatim (5 chunks of up to 700 characters, about 950 tokens), and savings are measured against that prompt
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("DOCBOT_CONTEXT_TOKEN_BUDGET", 800))
+CONTEXT_CANDIDATES = int(os.environ.get("DOCBOT_CONTEXT_CANDIDATES", 10))
+BASELINE_CHUNKS = 5
+CHARS_PER_TOKEN = 4
+# Chunks at least this similar (cosine of their stored vectors) to a better ranked source are dropped
+NEAR_DUPLICATE_SIMILARITY = 0.95
+# Neighbouring chunks of a page share up to the splitter's overlap (150 characters); merges look this far back
+MAX_MERGE_OVERLAP = 300
+MIN_MERGE_OVERLAP = 20
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _format_source(number, source):
+    return f"Source [{number}] from Document '{source['doc_name']}', Page {source['page_number']}:\nContent: {source['text']}"
+
+
+def _join_overlapping(first: str, second: str) -> str:
+    # Joins two consecutive chunks of a page, keeping the text they share only once
+    for size in range(min(len(first), len(second), MAX_MERGE_OVERLAP), MIN_MERGE_OVERLAP - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + "\n" + second
+
+
+def _merge_neighbours(chunks):
+    # Chunks of the same page that follow each other in the document (consecutive rows) become one source,
+    # ranked where its best chunk was
+    sources, starts, ends = [], {}, {}
+    for chunk in chunks:
+        row, page = chunk.get("row"), (chunk['doc_name'], chunk['page_number'])
+        if row is not None and (page, row - 1) in ends:
+            source = ends.pop((page, row - 1))
+            source["text"] = _join_overlapping(source["text"], chunk["text"])
+            source["merged"] += 1
+            ends[(page, row)] = source
+        elif row is not None and (page, row + 1) in starts:
+            source = starts.pop((page, row + 1))
+            source["text"] = _join_overlapping(chunk["text"], source["text"])
+            source["merged"] += 1
+            starts[(page, row)] = source
+        else:
+            source = dict(chunk, merged=1)
+            sources.append(source)
+            if row is not None:
+                starts[(page, row)] = ends[(page, row)] = source
+    return sources
+
+
+def _is_near_duplicate(source, kept) -> bool:
+    vector = source.get("vector")
+    for other in kept:
+        if source["text"] == other["text"]:
+            return True
+        if vector is not None and other.get("vector") is not None:
+            a, b = np.asarray(vector, dtype='float32'), np.asarray(other["vector"], dtype='float32')
+            norms = float(np.linalg.norm(a) * np.linalg.norm(b))
+            if norms and float(np.dot(a, b)) / norms >= NEAR_DUPLICATE_SIMILARITY:
+                return True
+    return False
+
+
+def build_context_from_chunks(chunks, token_budget: int = CONTEXT_TOKEN_BUDGET, stats=None):
+    # Turns the retrieved chunks (best first) into the numbered sources the model cites from. Neighbouring chunks of a
+    # page are merged so their overlap is sent once, near-duplicates are dropped, and sources are packed best first
+    # until token_budget is used up. If a dict is passed as stats, it receives the packed "sources" (matching the
+    # numbers in the context), "prompt_tokens", "baseline_tokens" (the top BASELINE_CHUNKS chunks pasted verbatim)
+    # and "tokens_saved" (negative when the packed context is the longer one)
+    if stats is None:
+        stats = {}
+    stats.update(sources=[], prompt_tokens=0, baseline_tokens=0, tokens_saved=0, merged=0, duplicates=0, over_budget=0)
+    if not chunks: return None
 
+    baseline = "\n\n---\n\n".join(_format_source(i + 1, chunk) for i, chunk in enumerate(chunks[:BASELINE_CHUNKS]))
+    kept, used = [], 0
+    separator_tokens = estimate_tokens("\n\n---\n\n")
+    for source in _merge_neighbours(chunks):
+        stats["merged"] += source.pop("merged") - 1
+        if _is_near_duplicate(source, kept):
+            stats["duplicates"] += 1
+            continue
+        cost = estimate_tokens(_format_source(len(kept) + 1, source)) + (separator_tokens if kept else 0)
+        if used + cost > token_budget:
+            if kept:
+                # A smaller source further down may still fit
+                stats["over_budget"] += 1
+                continue
+            # Even the best source alone is too long: it goes in cut down to the budget
+            source["text"] = source["text"][:max(0, token_budget * CHARS_PER_TOKEN - (cost * CHARS_PER_TOKEN - len(source["text"])))]
+            cost = estimate_tokens(_format_source(1, source))
+        kept.append(source)
+        used += cost
+
+    context = "\n\n---\n\n".join(_format_source(i + 1, source) for i, source in enumerate(kept))
+    stats["sources"] = kept
+    stats["prompt_tokens"] = estimate_tokens(context)
+    stats["baseline_tokens"] = estimate_tokens(baseline)
+    stats["tokens_saved"] = stats["baseline_tokens"] - stats["prompt_tokens"]
+    return context
+
+
+def _build_messages(query, context=None):
     if context:
         # There are two scenarios where the api gets called. These system prompts can be changed to fit a particular role
         # if context is given, it gives the answer to the user.
@@ -41,13 +160,21 @@ def ask_groq(query, context=None):
         )
         user_prompt = query
 
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+
+def ask_groq(query, context=None):
+    if not query:
+        return "⚠️ No query provided."
+
     try:
+        client = get_groq_client()
         response = client.chat.completions.create(
             model=model_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
+            messages=_build_messages(query, context),
             temperature=0.3,
             max_tokens=1024
         )
@@ -55,3 +182,41 @@ def ask_groq(query, context=None):
 
     except Exception as e:
         return f"❌ Error while calling Groq API: {e}"
+
+
+def ask_groq_stream(query, context=None, stats=None):
+    # Same as ask_groq, but yields the answer piece by piece as the tokens arrive.
+    # If a dict is passed as stats, "time_to_first_token" and "total_latency" (in seconds) are written into it
+    if stats is None:
+        stats = {}
+    if not query:
+        yield "⚠️ No query provided."
+        return
+
+    start_time = time.perf_counter()
+    try:
+        client = get_groq_client()
+        stream = client.chat.completions.create(
+            model=model_name,
+            messages=_build_messages(query, context),
+            temperature=0.3,
+            max_tokens=1024,
+            stream=True
+        )
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if "time_to_first_token" not in stats:
+                    stats["time_to_first_token"] = time.perf_counter() - start_time
+                yield delta
+
+    except Exception as e:
+        yield f"❌ Error while calling Groq API: {e}"
+
+    finally:
+        stats["total_latency"] = time.perf_counter() - start_time
+        if "time_to_first_token" in stats:
+            metrics.observe("query_groq_first_token", stats["time_to_first_token"])
+        metrics.observe("query_groq_total", stats["total_latency"])
@@ -1,103 +1,405 @@
-from sentence_transformers import SentenceTransformer
-import faiss
 import numpy as np
 import re
+import atexit
+import contextlib
+import os
+import threading
+import time
 import streamlit as st
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from backend import cache
+from backend import metrics
+from backend.chunkstore import ChunkStore
+from backend.embedders import EMBEDDING_BACKEND, EMBEDDING_MODEL_PATH, ONNX_INT8_FILE, load_embedder
 
-# The embedder is responsible for converting the text to vectors which can be used for comparison for further use
-try:
-    embedder = SentenceTransformer("all-MiniLM-L6-v2")
-except Exception as e:
-    st.error(f"Failed to load SentenceTransformer model: {e}. Please check your internet connection and dependencies.")
-    st.stop()
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+CHUNK_SIZE = 700          # Increased chunk size for more context
+CHUNK_OVERLAP = 150       # Overlap in order to ensure that the other chunks has more context to work with
+CHUNK_SEPARATORS = ["\n\n", "\n", ". ", " ", ""] # Order of separators for splitting
+MIN_CHUNK_CHARS = 25      # Ensure chunks are meaningful
+# Chunks per embedding batch, and worker processes for embedding (1 = embed in this process)
+EMBED_BATCH_SIZE = int(os.environ.get("DOCBOT_EMBED_BATCH_SIZE", 64))
+EMBED_WORKERS = int(os.environ.get("DOCBOT_EMBED_WORKERS", 1))
+# Documents flow through splitting, embedding and the index this many chunks at a time, so only one window
+# of chunks and vectors is in memory however long the document is
+STREAM_WINDOW_CHUNKS = int(os.environ.get("DOCBOT_STREAM_WINDOW_CHUNKS", 1024))
+# Rough chunks per page, to size a new index before the chunk count of a streamed document is known
+CHUNKS_PER_PAGE_ESTIMATE = 3
+# Hybrid retrieval: both the vector and the BM25 search return this many candidates per wanted hit,
+# and the two rankings are merged with reciprocal rank fusion (score = sum of 1 / (RRF_K + rank))
+HYBRID_SEARCH = os.environ.get("DOCBOT_HYBRID_SEARCH", "1") != "0"
+FUSION_CANDIDATES_FACTOR = 4
+RRF_K = 60
 
-# Initialize a robust text splitter from LangChain
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=700,      # Increased chunk size for more context
-    chunk_overlap=150,   # Overlap in order to ensure that the other chunks has more context to work with
-    length_function=len,
-    separators=["\n\n", "\n", ". ", " ", ""] # Order of separators for splitting
-)
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
 
 
-def create_faiss_index(docs_with_meta: dict):
-    # Creates a FAISS index from a dictionary of documents and their metadata. This receives the dictionary and then returns the Faiss index and the metadata chunks
-    all_chunks_text = []
-    all_chunks_metadata = []
-    global_chunk_id = 0
+@st.cache_resource(show_spinner="Loading the embedding model...")
+def get_embedder():
+    # The embedder is responsible for converting the text to vectors which can be used for comparison for further use.
+    # It is loaded on first use and shared by all sessions, so pages that don't need it never wait for torch and the weights.
+    # Failures raise, so they are not cached and the next call retries; callers report them (st.stop would do nothing
+    # on the ingest threads)
+    try:
+        # The runtime (PyTorch, ONNX, int8) and a local model path can be picked, see backend.embedders
+        return load_embedder(EMBEDDING_MODEL_NAME)
+    except Exception as e:
+        raise RuntimeError(f"Failed to load the embedding model: {e}. Please check your internet connection and dependencies.") from e
 
-    if not docs_with_meta:
-        st.warning("No documents provided to create FAISS index.")
-        return None, []
+
+@st.cache_resource(show_spinner=False)
+def get_text_splitter():
+    # Initialize a robust text splitter from LangChain
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        length_function=len,
+        separators=CHUNK_SEPARATORS
+    )
+
+
+def embedding_settings() -> dict:
+    # Everything that changes the chunks or their vectors, including the OCR settings that produced the page text.
+    # Used as part of the cache key for embeddings
+    from backend.ingest import ocr_settings
+    return {
+        "ocr": ocr_settings(),
+        "model": EMBEDDING_MODEL_NAME,
+        "model_path": EMBEDDING_MODEL_PATH,
+        "backend": EMBEDDING_BACKEND,
+        "onnx_file": ONNX_INT8_FILE if EMBEDDING_BACKEND == "onnx-int8" else None,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "separators": CHUNK_SEPARATORS,
+        "min_chunk_chars": MIN_CHUNK_CHARS,
+    }
+
+
+def _iter_chunks(pages):
+    # Splits the pages of one document into chunks as the pages arrive, each chunk remembering the page it came from
+    for page_entry in pages:
+        page_text = page_entry.get('text', '')
+        page_number = page_entry.get('page_number')
+
+        # Use the robust text splitter
+        with metrics.span("ingest_split"):
+            page_chunks = get_text_splitter().split_text(page_text)
+        for chunk_content in page_chunks:
+            if len(chunk_content.strip()) > MIN_CHUNK_CHARS:
+                yield {"text": chunk_content, "page_number": page_number}
+
+
+def _windows(items, size: int):
+    window = []
+    for item in items:
+        window.append(item)
+        if len(window) == size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def _plan_documents(docs_with_meta: dict) -> list[dict]:
+    # Documents whose content hash is known are looked up in the embedding cache first and come with their
+    # (memory-mapped) vectors; the others keep their pages, which are split and embedded while they stream in.
+    # 'pages' can be a list, cached pages or a generator still reading the PDF, with 'page_count' next to it
+    settings = embedding_settings()
+    plans = []
 
     for doc_name, doc_data in docs_with_meta.items():
-        pages_data_list = doc_data.get('pages', [])
-        doc_meta = doc_data.get('metadata', {}) # Author, creation date, etc.
+        pages = doc_data.get('pages')
+        page_count = doc_data['page_count'] if 'page_count' in doc_data else len(pages or [])
+        file_hash = doc_data.get('hash')
 
-        if not pages_data_list:
+        if not pages or not page_count:
             continue
 
-        for page_entry in pages_data_list:
-            page_text = page_entry.get('text', '')
-            page_number = page_entry.get('page_number')
-
-            # Use the robust text splitter
-            chunks_from_page = text_splitter.split_text(page_text)
-
-            for chunk_content in chunks_from_page:
-                if len(chunk_content.strip()) > 25: # Ensure chunks are meaningful
-                    all_chunks_text.append(chunk_content)
-                    
-                    # Metadata for each chunk
-                    chunk_meta = {
-                        "doc_name": doc_name,
-                        "chunk_id": f"{doc_name}_page{page_number}_chunk{global_chunk_id}", # Unique ID for citations
-                        "text": chunk_content,
-                        "page_number": page_number,
-                    }
-                    # Add the document-level metadata to the chunk-level metadata
-                    chunk_meta.update(doc_meta)
-                    all_chunks_metadata.append(chunk_meta)
-                    
-                    global_chunk_id += 1
-
-    if not all_chunks_text:
-        st.toast("❌ No valid text chunks were found to index.")
-        return None, []
+        plan = {
+            "doc_name": doc_name,
+            "doc_meta": doc_data.get('metadata', {}), # Author, creation date, etc.
+            "hash": file_hash,
+            "pages": pages,
+            "chunks": None,
+            "vectors": None,
+            "estimate": page_count * CHUNKS_PER_PAGE_ESTIMATE,
+        }
+        cached = cache.load_chunks(file_hash, settings) if file_hash else None
+        if cached is not None:
+            plan["chunks"], plan["vectors"] = cached
+            plan["estimate"] = len(plan["chunks"])
+        plans.append(plan)
+    return plans
+
+
+def _get_encode_pool():
+    # Worker processes for embedding, started once per process on first use and stopped at exit.
+    # Several ingest threads can get here at once, so the pool is started under a lock
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            embedder = get_embedder()
+            _encode_pool = embedder.start_multi_process_pool(["cpu"] * EMBED_WORKERS)
+            atexit.register(embedder.stop_multi_process_pool, _encode_pool)
+    return _encode_pool
+
+
+def embed_in_batches(texts: list[str], batch_size: int = EMBED_BATCH_SIZE):
+    # Yields (positions, vectors) batches covering all texts. Texts are sorted by length first so every batch
+    # holds texts of similar length and the model wastes little work on padding. With EMBED_WORKERS > 1 each
+    # step hands EMBED_WORKERS batches to the multi-process pool at once.
+    order = np.argsort(np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts)), kind="stable")
+    step = batch_size * max(1, EMBED_WORKERS)
+    for start in range(0, len(order), step):
+        positions = order[start:start + step]
+        batch = [texts[i] for i in positions]
+        if EMBED_WORKERS > 1:
+            # chunk_size hands each worker one whole length-sorted batch; left unset, the pool cuts them much smaller
+            vectors = get_embedder().encode_multi_process(batch, _get_encode_pool(), batch_size=batch_size, chunk_size=batch_size)
+        else:
+            vectors = get_embedder().encode(batch, batch_size=batch_size, show_progress_bar=False)
+        yield positions, np.asarray(vectors, dtype='float32')
+
+
+def _embed_window(texts: list[str]) -> np.ndarray:
+    # Embeds one window of texts in length-sorted batches and returns the vectors in the original order
+    vectors = None
+    for positions, batch in embed_in_batches(texts):
+        if vectors is None:
+            vectors = np.empty((len(texts), batch.shape[1]), dtype='float32')
+        vectors[positions] = batch
+    return vectors
+
+
+def _embed_pages(pages, on_window, progress=None, done: int = 0, total: int = 0) -> int:
+    # Splits and embeds the pages of one document a window of STREAM_WINDOW_CHUNKS chunks at a time and hands every
+    # window to on_window(chunks, vectors). progress(done, total) counts on from done, with total as an estimate.
+    # Returns the number of chunks embedded
+    embedded = 0
+    for window in _windows(_iter_chunks(pages), STREAM_WINDOW_CHUNKS):
+        with metrics.span("ingest_embed"):
+            vectors = _embed_window([chunk["text"] for chunk in window])
+        on_window(window, vectors)
+        embedded += len(window)
+        if progress:
+            progress(done + embedded, max(total, done + embedded))
+    return embedded
+
+
+def _report_throughput(embedded: int, start_time: float, notify):
+    elapsed = time.perf_counter() - start_time
+    chunks_per_sec = embedded / elapsed if elapsed > 0 else 0.0
+    print(f"Embedded {embedded} chunks in {elapsed:.1f}s ({chunks_per_sec:.1f} chunks/sec, {EMBED_WORKERS} worker(s))")
+    notify(f"Embedded {embedded} chunks ({chunks_per_sec:.0f} chunks/sec).")
+
+
+def _add_rows(builder, store: ChunkStore, doc_position: int, chunks: list[dict], vectors: np.ndarray):
+    # A chunk's FAISS ID is its row in the chunk store, so both are appended together
+    first_id = len(store)
+    builder.add(vectors, np.arange(first_id, first_id + len(chunks)))
+    for chunk in chunks:
+        store.append(doc_position, chunk["page_number"], chunk["text"])
+
+
+def create_faiss_index(docs_with_meta: dict):
+    # Creates a FAISS index from a dictionary of documents and their metadata. This receives the dictionary and then returns the Faiss index and the chunk store
+    if not docs_with_meta:
+        st.warning("No documents provided to create FAISS index.")
+        return None, None
+
+    index, store = add_documents_to_index(None, ChunkStore(), docs_with_meta)
+    if index is None:
+        return None, None
+    st.toast(f"✅ FAISS index created with {index.ntotal} vectors.")
+    return index, store
+
+
+def add_documents_to_index(index, store: ChunkStore, docs_with_meta: dict, progress=None, notify=None):
+    # Adds documents to an existing index (or a new one when index is None) and returns the index and chunk store.
+    # The index is ID-mapped and a chunk's ID is its row in the chunk store, so only the new chunks get
+    # embedded and earlier IDs stay valid. Removed chunks stay behind as dead rows in the store.
+    # Documents stream through in windows of STREAM_WINDOW_CHUNKS: pages are split, embedded, added to the index,
+    # the store and the embedding cache one window at a time. progress(done, total) is called after each window,
+    # where total is an estimate until the last document is through.
+    # Background jobs pass notify to receive the status messages that otherwise go to st.toast / st.error.
+    writer = None
+    builder = None
+    first_id = len(store)
+    in_page = notify is None
+    notify = notify or st.toast
+
+    # faiss is only imported once an index is built or searched, not when the app starts
+    from backend.indexes import IndexBuilder, remove_ids, upgrade_index
 
     # Embed and Create FAISS Index
     try:
-        with st.spinner(f"Generating {len(all_chunks_text)} embeddings..."):
-            vectors = embedder.encode(all_chunks_text, show_progress_bar=True)
-        
-        vectors = np.array(vectors, dtype='float32')
-        dimension = vectors.shape[1]
-        index = faiss.IndexFlatL2(dimension)
-        index.add(vectors)
-        
-        st.toast(f"✅ FAISS index created with {index.ntotal} vectors.")
-        return index, all_chunks_metadata
-        
+        plans = _plan_documents(docs_with_meta)
+        total = sum(plan["estimate"] for plan in plans)
+        builder = IndexBuilder(index, max(total, 1))
+        settings = embedding_settings()
+        done = embedded = 0
+        start_time = time.perf_counter()
+
+        with st.spinner("Generating embeddings...") if in_page else contextlib.nullcontext():
+            for plan in plans:
+                # The document-level metadata (author, creation date, etc.) is stored once per document
+                doc_position = store.add_document(plan["doc_name"], plan["doc_meta"])
+
+                # Cached documents already have their vectors
+                if plan["vectors"] is not None:
+                    for start in range(0, len(plan["chunks"]), EMBED_BATCH_SIZE):
+                        _add_rows(builder, store, doc_position, plan["chunks"][start:start + EMBED_BATCH_SIZE], plan["vectors"][start:start + EMBED_BATCH_SIZE])
+                    done += len(plan["chunks"])
+                    if progress:
+                        progress(done, max(total, done))
+                    continue
+
+                writer = cache.open_chunk_writer(plan["hash"], settings) if plan["hash"] else None
+
+                def add_window(window, vectors, doc_position=doc_position, writer=writer):
+                    with metrics.span("ingest_index"):
+                        _add_rows(builder, store, doc_position, window, vectors)
+                    if writer is not None:
+                        writer.append(window, vectors)
+                count = _embed_pages(plan["pages"], add_window, progress, done, total)
+                done += count
+                embedded += count
+                if writer is not None:
+                    writer.commit()
+                    writer = None
+
+        if embedded:
+            _report_throughput(embedded, start_time, notify)
+        if not done:
+            notify("❌ No valid text chunks were found to index.")
+            return index, store
+        if progress:
+            progress(done, done)
+        # Documents mostly arrive one at a time, so the index type is checked again as the index grows
+        with metrics.span("ingest_index"):
+            index = upgrade_index(builder.finish(), store.live_rows())
+        return index, store
+
     except Exception as e:
-        st.error(f"Error during embedding or indexing: {e}")
-        return None, []
+        if in_page:
+            st.error(f"Error during embedding or indexing: {e}")
+        else:
+            notify(f"Error during embedding or indexing: {e}")
+        # Don't leave half a document behind: rows added by this call and their vectors are dropped again
+        new_rows = np.arange(first_id, len(store), dtype='int64')
+        store.remove_rows(new_rows)
+        if index is not None and new_rows.size:
+            index = remove_ids(index, new_rows, store.live_rows())
+        return index, store
+
+    finally:
+        if writer is not None:
+            writer.abort()
+
+
+def embed_document(doc_data: dict, progress=None, notify=None) -> bool | None:
+    # Streams one document's pages through splitting and embedding into the embedding cache, without touching an index,
+    # so it can run while others keep searching. Returns True once its chunks are in the cache (or already were), False
+    # when it has no chunks, and None when the cache can't be written; its pages are left unread in that case.
+    settings = embedding_settings()
+    if cache.load_chunks(doc_data['hash'], settings) is not None:
+        return True
+    writer = cache.open_chunk_writer(doc_data['hash'], settings)
+    if writer is None:
+        return None
+    notify = notify or st.toast
+    pages = doc_data.get('pages') or []
+    estimate = (doc_data['page_count'] if 'page_count' in doc_data else len(pages)) * CHUNKS_PER_PAGE_ESTIMATE
+    start_time = time.perf_counter()
+    try:
+        done = _embed_pages(pages, writer.append, progress, total=estimate)
+        if not done:
+            return False
+        writer.commit()
+        writer = None
+    finally:
+        if writer is not None:
+            writer.abort()
+    _report_throughput(done, start_time, notify)
+    return True
 
 
-def search_index(query: str, index: faiss.Index, metadata: list[dict], top_k: int = 10) -> list[dict]:
+def remove_documents_from_index(index, store: ChunkStore, doc_names) -> tuple:
+    # Deletes the vectors of the given documents from the index, without re-embedding anything else
+    from backend.indexes import remove_ids
+
+    if index is None:
+        return index, store
+    ids = store.remove_documents(doc_names)
+    if ids.size == 0:
+        return index, store
+
+    index = remove_ids(index, ids, store.live_rows())
+    return index, store
+
+
+def embed_query(query: str) -> np.ndarray:
+    # Embeds a single query as a (1, dimension) float32 array
+    return np.asarray(get_embedder().encode([query], convert_to_tensor=False), dtype='float32')
+
+
+def _reciprocal_rank_fusion(rankings: list[list[int]], top_k: int) -> list[int]:
+    scores = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:top_k]
+
+
+def search_index(query: str, index, store: ChunkStore, top_k: int = 10, doc_names=None, query_vector=None, timings=None, with_vectors=False) -> list[dict]:
     # Searches the FAISS index and returns the top matching chunks using vector distancing along with the full metadata.
+    # When doc_names is given, the search is restricted to those documents inside FAISS itself, so top_k hits
+    # always come from the allowed documents instead of being filtered out afterwards.
+    # With hybrid search on, a BM25 lookup over the same chunks runs as well and the two rankings are fused,
+    # so exact terms like invoice numbers or clause IDs are found even when the embedding misses them.
+    # A query_vector from embed_query can be passed when the caller needs the embedding as well.
+    # Each step is timed into backend.metrics; pass a dict as timings to also get this query's breakdown.
+    # with_vectors adds each hit's stored vector as "vector" (None when the index type can't return it).
+
+    from backend.indexes import filtered_search, reconstruct
 
     if index is None:
         return []
 
     try:
-        query_vector = embedder.encode([query], convert_to_tensor=False).astype('float32')
-        distances, indices = index.search(query_vector, top_k)
-        
-        results = [metadata[i] for i in indices[0] if 0 <= i < len(metadata)]
-        return results
-        
+        allowed_rows = None
+        with metrics.span("query_filter", timings):
+            if doc_names:
+                allowed_rows = store.rows_for_documents(doc_names)
+        if allowed_rows is not None and allowed_rows.size == 0:
+            return []
+
+        if query_vector is None:
+            with metrics.span("query_embed", timings):
+                query_vector = embed_query(query)
+        candidates = top_k * FUSION_CANDIDATES_FACTOR if HYBRID_SEARCH else top_k
+        with metrics.span("query_faiss", timings):
+            distances, indices = filtered_search(index, query_vector, candidates, allowed_rows)
+            dense_rows = [int(i) for i in indices[0] if store.is_alive(int(i))]
+
+        if HYBRID_SEARCH:
+            with metrics.span("query_bm25", timings):
+                allowed_mask = store.row_mask(allowed_rows) if allowed_rows is not None else None
+                lexical_rows = store.lexical.search(query, candidates, allowed_mask)
+            rows = _reciprocal_rank_fusion([dense_rows, lexical_rows], top_k)
+        else:
+            rows = dense_rows[:top_k]
+
+        # Dicts are only built for the hits that are returned
+        with metrics.span("query_rows", timings):
+            chunks = store.rows(rows)
+            if with_vectors and chunks:
+                vectors = reconstruct(index, [chunk["row"] for chunk in chunks])
+                for i, chunk in enumerate(chunks):
+                    chunk["vector"] = vectors[i] if vectors is not None else None
+            return chunks
+
     except Exception as e:
         st.error(f"❌ Error during FAISS search: {e}")
         return []
-
@@ -0,0 +1,79 @@
+# benchmarks/bench_ann.py
+#
+# Recall vs latency of the approximate index types against the exact flat baseline.
+# Uses synthetic clustered vectors with the dimension of all-MiniLM-L6-v2, so no model or network is needed.
+#
+#   python -m benchmarks.bench_ann --num-vectors 200000 --queries 500
+
+import argparse
+import time
+
+import numpy as np
+
+from backend import indexes
+from backend.indexes import INDEX_TYPES, build_faiss_index, search_parameters
+
+
+def synthetic_vectors(num_vectors: int, dimension: int, seed: int = 0) -> np.ndarray:
+    # Gaussian blobs around random centres look more like sentence embeddings than uniform noise does
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((max(1, num_vectors // 500), dimension)).astype('float32')
+    assignment = rng.integers(0, len(centres), num_vectors)
+    vectors = centres[assignment] + 0.3 * rng.standard_normal((num_vectors, dimension)).astype('float32')
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def timed_search(index, queries: np.ndarray, top_k: int):
+    params = search_parameters(index)
+    start = time.perf_counter()
+    for query in queries:
+        _, labels = index.search(query[None, :], top_k, params=params)
+    single_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    _, labels = index.search(queries, top_k, params=params)
+    return labels, single_ms
+
+
+def recall_at_k(labels: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(found) & set(expected)) for found, expected in zip(labels, truth))
+    return hits / truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-vectors", type=int, default=100_000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="*", default=[4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="*", default=[32, 64, 128])
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.num_vectors, args.dimension)
+    queries = synthetic_vectors(args.queries, args.dimension, seed=1)
+    ids = np.arange(args.num_vectors, dtype='int64')
+
+    print(f"{'index':<10} {'param':<14} {'build s':>8} {'ms/query':>9} {'recall@' + str(args.top_k):>10}")
+    truth = None
+    for index_type in INDEX_TYPES:
+        start = time.perf_counter()
+        index = build_faiss_index(vectors, ids, index_type)
+        build_s = time.perf_counter() - start
+
+        if index_type == "flat":
+            sweep = [("exact", None)]
+        elif index_type == "hnsw":
+            sweep = [(f"efSearch={ef}", ("HNSW_EF_SEARCH", ef)) for ef in args.ef_search]
+        else:
+            sweep = [(f"nprobe={nprobe}", ("IVF_NPROBE", nprobe)) for nprobe in args.nprobe]
+
+        for label, setting in sweep:
+            if setting:
+                setattr(indexes, *setting)
+            labels, single_ms = timed_search(index, queries, args.top_k)
+            if truth is None:
+                truth = labels
+            print(f"{index_type:<10} {label:<14} {build_s:>8.2f} {single_ms:>9.3f} {recall_at_k(labels, truth):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# benchmarks/bench_embedders.py
+#
+# Parity and speed of the CPU embedding backends against the PyTorch reference model.
+# Parity is the cosine similarity of each backend's vectors to the PyTorch vectors for the same texts;
+# the script exits non-zero when a backend falls below --min-cosine. Point --model-path at a local copy of
+# all-MiniLM-L6-v2 (with its onnx/ folder) to run without network access.
+#
+#   python -m benchmarks.bench_embedders --model-path ./models/all-MiniLM-L6-v2 --backends onnx onnx-int8
+
+import argparse
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from backend.embedders import EMBEDDING_BACKENDS, load_embedder
+
+WORDS = ("invoice contract clause payment tenant landlord agreement party term notice liability amount "
+         "delivery schedule warranty termination section page total balance due date signature").split()
+
+
+def synthetic_texts(count: int, seed: int = 0) -> list[str]:
+    # Chunk-like texts of mixed length, from a few words up to about the 700 character chunk size
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 110))) for _ in range(count)]
+
+
+def cosine_rows(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return np.sum(a * b, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding backend parity and throughput")
+    parser.add_argument("--model-name", default="all-MiniLM-L6-v2")
+    parser.add_argument("--model-path", default=None)
+    parser.add_argument("--backends", nargs="*", default=[b for b in EMBEDDING_BACKENDS if b != "torch"])
+    parser.add_argument("--texts", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    args = parser.parse_args()
+
+    texts = synthetic_texts(args.texts)
+    queries = synthetic_texts(args.queries, seed=1)
+    reference = None
+    failed = False
+
+    print(f"{'backend':<11} {'load s':>7} {'chunks/s':>9} {'query ms':>9} {'min cos':>8} {'mean cos':>9}")
+    for backend in ["torch"] + [b for b in args.backends if b != "torch"]:
+        start = time.perf_counter()
+        model = load_embedder(args.model_name, backend=backend, model_path=args.model_path)
+        load_s = time.perf_counter() - start
+
+        model.encode(texts[:args.batch_size], batch_size=args.batch_size)  # Warm up
+        start = time.perf_counter()
+        vectors = np.asarray(model.encode(texts, batch_size=args.batch_size), dtype='float32')
+        chunks_per_sec = len(texts) / (time.perf_counter() - start)
+
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            model.encode([query])
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        if reference is None:
+            reference = vectors
+        similarity = cosine_rows(vectors, reference)
+        failed |= bool(similarity.min() < args.min_cosine)
+        print(f"{backend:<11} {load_s:>7.2f} {chunks_per_sec:>9.1f} {statistics.median(latencies):>9.2f} {similarity.min():>8.4f} {similarity.mean():>9.4f}")
+
+    if failed:
+        print(f"At least one backend fell below the minimum cosine similarity of {args.min_cosine}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
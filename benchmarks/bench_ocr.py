@@ -0,0 +1,101 @@
+# benchmarks/bench_ocr.py
+#
+# OCR time against character accuracy for the render settings. Synthetic pages at several font sizes are rendered
+# to image-only "scans" with PyMuPDF; their text layer before rasterizing is the ground truth. Every variant OCRs the
+# same pages, and accuracy is 1 - (character edit distance / length of the truth), after collapsing whitespace.
+# "baseline" is the old path: colour render at a fixed 300 DPI, PNG encoded and decoded again by PIL.
+#
+#   python -m benchmarks.bench_ocr --pages 3 --font-sizes 8 10 14 20
+
+import argparse
+import io
+import os
+import re
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from backend import ingest
+from benchmarks.bench_pipeline import make_pdf
+
+
+def ocr_baseline(page) -> str:
+    import pytesseract
+    from PIL import Image
+
+    pix = page.get_pixmap(dpi=300)
+    img = Image.open(io.BytesIO(pix.tobytes("png")))
+    return pytesseract.image_to_string(img, lang=ingest.OCR_LANG)
+
+
+VARIANTS = {
+    "baseline": ocr_baseline,
+    "gray_300": lambda page: ingest._ocr_page(page, dpi=ingest.OCR_DPI, crop=False),
+    "gray_300_crop": lambda page: ingest._ocr_page(page, dpi=ingest.OCR_DPI, crop=True),
+    "adaptive": lambda page: ingest._ocr_page(page, crop=False),
+    "adaptive_crop": lambda page: ingest._ocr_page(page, crop=True),
+}
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def edit_distance(a: str, b: str) -> int:
+    # Levenshtein distance, one numpy row per character of a. Insertions within a row are resolved with a running
+    # minimum, so there is no Python loop over b
+    codes = np.frombuffer(b.encode("utf-32-le"), dtype=np.uint32)
+    offsets = np.arange(len(b) + 1)
+    previous = offsets.copy()
+    for i, char in enumerate(a, 1):
+        row = np.empty_like(previous)
+        row[0] = i
+        row[1:] = np.minimum(previous[1:] + 1, previous[:-1] + (codes != ord(char)))
+        previous = np.minimum.accumulate(row - offsets) + offsets
+    return int(previous[-1])
+
+
+def char_accuracy(ocr_text: str, truth: str) -> float:
+    ocr_text, truth = normalize(ocr_text), normalize(truth)
+    if not truth:
+        return 1.0 if not ocr_text else 0.0
+    return max(0.0, 1 - edit_distance(ocr_text, truth) / len(truth))
+
+
+def main():
+    import fitz
+
+    parser = argparse.ArgumentParser(description="OCR time vs character accuracy of the render settings")
+    parser.add_argument("--pages", type=int, default=3, help="Pages per font size")
+    parser.add_argument("--font-sizes", type=float, nargs="*", default=[8, 10, 14, 20])
+    parser.add_argument("--scan-dpi", type=int, default=300)
+    parser.add_argument("--variants", nargs="*", choices=list(VARIANTS), default=list(VARIANTS))
+    args = parser.parse_args()
+
+    print(f"{'font pt':>7} {'variant':<14} {'dpi':>5} {'s/page':>7} {'accuracy':>9}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for fontsize in args.font_sizes:
+            text_path = os.path.join(tmp_dir, f"text_{fontsize}.pdf")
+            scan_path = os.path.join(tmp_dir, f"scan_{fontsize}.pdf")
+            make_pdf(text_path, args.pages, fontsize=fontsize)
+            make_pdf(scan_path, args.pages, scanned=True, fontsize=fontsize, scan_dpi=args.scan_dpi)
+            with fitz.open(text_path) as text_doc:
+                truths = [page.get_text() for page in text_doc]
+
+            with fitz.open(scan_path) as scan_doc:
+                dpi = statistics.median(ingest.choose_dpi(page) for page in scan_doc)
+                for name in args.variants:
+                    seconds, accuracies = 0.0, []
+                    for page, truth in zip(scan_doc, truths):
+                        start = time.perf_counter()
+                        text = VARIANTS[name](page)
+                        seconds += time.perf_counter() - start
+                        accuracies.append(char_accuracy(text, truth))
+                    shown_dpi = dpi if name.startswith("adaptive") else ingest.OCR_DPI
+                    print(f"{fontsize:>7g} {name:<14} {shown_dpi:>5g} {seconds / len(truths):>7.2f} {statistics.mean(accuracies):>9.4f}")
+
+
+if __name__ == "__main__":
+    main()
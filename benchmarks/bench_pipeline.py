@@ -0,0 +1,281 @@
+# benchmarks/bench_pipeline.py
+#
+# Timings and peak memory of the ingest and retrieval stages on synthetic data, written to a JSON report that can be
+# compared against the report of another commit. Everything is generated locally: PDFs with PyMuPDF (born-digital
+# ones with a text layer and rasterized "scans" that go through OCR), chunk texts, and random vectors for the query
+# benchmarks. Indexing uses a hashing embedder by default, so no model download is needed and the numbers show the
+# pipeline itself; pass --real-embedder to include the configured model. Every case runs in a fresh process so
+# its peak RSS is its own.
+#
+#   python -m benchmarks.bench_pipeline --output before.json
+#   python -m benchmarks.bench_pipeline --output after.json --compare before.json
+#
+# --compare exits non-zero when a case got slower (or bigger) than the baseline by more than --tolerance.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmarks.bench_ann import synthetic_vectors
+from benchmarks.bench_embedders import synthetic_texts
+
+STAGES = ("extract", "index", "search", "context")
+SCAN_DPI = 150
+DIMENSION = 384
+# Distinct texts generated for the query benchmarks; larger stores reuse them with a row-specific suffix
+TEXT_POOL_SIZE = 10_000
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def page_text(rng: random.Random, page_num: int) -> str:
+    paragraphs = synthetic_texts(6, seed=rng.randrange(1 << 30))
+    return f"Invoice INV-2024-{page_num:05d}, section {page_num % 17}.{page_num % 5}\n\n" + "\n\n".join(paragraphs)
+
+
+def make_pdf(path: str, pages: int, scanned: bool = False, seed: int = 0, fontsize: float = 10, scan_dpi: int = SCAN_DPI):
+    # Writes a PDF of synthetic text pages. Scanned PDFs hold only a rendered image of every page, no text layer
+    import fitz
+
+    rng = random.Random(seed)
+    doc = fitz.open()
+    out = fitz.open() if scanned else doc
+    for page_num in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(page.rect + (50, 50, -50, -50), page_text(rng, page_num), fontsize=fontsize)
+        if scanned:
+            pix = page.get_pixmap(dpi=scan_dpi)
+            scan = out.new_page(width=page.rect.width, height=page.rect.height)
+            scan.insert_image(scan.rect, pixmap=pix)
+            doc.delete_page(0)
+    out.save(path)
+    out.close()
+    if scanned:
+        doc.close()
+
+
+class HashingEmbedder:
+    """ Stands in for the sentence-transformer: every word is hashed into one of `dimension` buckets and the counts
+    are normalized. Deterministic and fast, with the same encode() call the pipeline uses."""
+
+    def __init__(self, dimension: int = DIMENSION):
+        self.dimension = dimension
+
+    def encode(self, texts, batch_size=None, show_progress_bar=False, convert_to_tensor=False):
+        vectors = np.zeros((len(texts), self.dimension), dtype='float32')
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                vectors[row, zlib.crc32(word.encode("utf-8")) % self.dimension] += 1
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+def use_embedder(real: bool):
+    from backend import vectorstore
+    if not real:
+        embedder = HashingEmbedder()
+        vectorstore.get_embedder = lambda: embedder
+
+
+# Cases. Each runs in its own process and returns its measurements
+
+def run_extract(path: str, pages: int, workers: int | None) -> dict:
+    from backend.ingest import extract_metadata_and_text
+
+    start = time.perf_counter()
+    page_data, _ = extract_metadata_and_text(path, workers=workers, notify=lambda message: None)
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "pages": pages, "pages_read": len(page_data), "pages_per_sec": pages / seconds}
+
+
+def run_index(pages: int, real_embedder: bool) -> dict:
+    from backend.vectorstore import create_faiss_index
+
+    use_embedder(real_embedder)
+    rng = random.Random(0)
+    docs = {"bench.pdf": {"pages": [{"text": page_text(rng, i), "page_number": i + 1} for i in range(pages)], "metadata": {}, "hash": None}}
+    start = time.perf_counter()
+    index, store = create_faiss_index(docs)
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "pages": pages, "chunks": len(store), "chunks_per_sec": len(store) / seconds}
+
+
+def build_store(num_chunks: int, num_docs: int = 10):
+    # A chunk store and index of num_chunks synthetic chunks spread over num_docs documents
+    from backend.chunkstore import ChunkStore
+    from backend.indexes import IndexBuilder
+
+    texts = synthetic_texts(min(num_chunks, TEXT_POOL_SIZE))
+    vectors = synthetic_vectors(num_chunks, DIMENSION)
+    store = ChunkStore()
+    positions = [store.add_document(f"doc{i}.pdf", {"author": "Unknown", "title": "Unknown", "creation_date": None}) for i in range(num_docs)]
+    builder = IndexBuilder(None, num_chunks)
+    batch = 10_000
+    for start in range(0, num_chunks, batch):
+        end = min(start + batch, num_chunks)
+        builder.add(vectors[start:end], np.arange(start, end))
+        for row in range(start, end):
+            store.append(positions[row * num_docs // num_chunks], row // 5 + 1, f"{texts[row % len(texts)]} ref-{row}")
+    return builder.finish(), store
+
+
+def run_search(num_chunks: int, queries: int, top_k: int) -> dict:
+    from backend import vectorstore
+    from backend.indexes import index_type_of
+
+    start = time.perf_counter()
+    index, store = build_store(num_chunks)
+    build_seconds = time.perf_counter() - start
+    query_texts = synthetic_texts(queries, seed=1)
+    query_vectors = synthetic_vectors(queries, DIMENSION, seed=1)
+
+    result = {"chunks": num_chunks, "index_type": index_type_of(index), "build_seconds": build_seconds}
+    for label, hybrid, doc_names in (("dense", False, None), ("hybrid", True, None), ("hybrid_filtered", True, ["doc0.pdf", "doc1.pdf"])):
+        vectorstore.HYBRID_SEARCH = hybrid
+        latencies = []
+        for text, vector in zip(query_texts, query_vectors):
+            start = time.perf_counter()
+            vectorstore.search_index(text, index, store, top_k=top_k, doc_names=doc_names, query_vector=vector[None, :])
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+        result[f"{label}_p50_ms"] = statistics.median(latencies)
+        result[f"{label}_p95_ms"] = latencies[int(len(latencies) * 0.95) - 1]
+    result["p50_ms"] = result["hybrid_p50_ms"]
+    return result
+
+
+def run_context(top_k: int, repeats: int) -> dict:
+    from backend.qa import build_context_from_chunks
+
+    texts = synthetic_texts(top_k)
+    chunks = [{"doc_name": f"doc{i % 3}.pdf", "page_number": i + 1, "text": text} for i, text in enumerate(texts)]
+    start = time.perf_counter()
+    for _ in range(repeats):
+        context = build_context_from_chunks(chunks)
+    us_per_call = (time.perf_counter() - start) * 1e6 / repeats
+    return {"top_k": top_k, "us_per_call": us_per_call, "context_chars": len(context)}
+
+
+def _measured(func, *args) -> dict:
+    result = func(*args)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_isolated(func, *args) -> dict:
+    # A fresh interpreter per case, so imports, caches and peak RSS don't carry over between cases
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_measured, func, *args).result()
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Comparison. Every case names the metric it is judged by; lower is better for all of them
+
+def compare(current: dict, baseline: dict, tolerance: float) -> bool:
+    previous = {(r["stage"], r["case"]): r for r in baseline["results"]}
+    regressed = False
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'} (tolerance {tolerance:.0%})")
+    print(f"{'stage':<8} {'case':<22} {'metric':<14} {'before':>10} {'after':>10} {'change':>8}")
+    for result in current["results"]:
+        before = previous.get((result["stage"], result["case"]))
+        if before is None:
+            continue
+        for metric in (result["metric"], "peak_rss_mb"):
+            if metric not in before or not before[metric]:
+                continue
+            change = result[metric] / before[metric] - 1
+            flag = " !" if change > tolerance else ""
+            regressed |= change > tolerance
+            print(f"{result['stage']:<8} {result['case']:<22} {metric:<14} {before[metric]:>10.3f} {result[metric]:>10.3f} {change:>+7.0%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest and retrieval benchmarks on synthetic data")
+    parser.add_argument("--stages", nargs="*", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--text-pages", type=int, nargs="*", default=[10, 100, 1000])
+    parser.add_argument("--scan-pages", type=int, nargs="*", default=[5, 25])
+    parser.add_argument("--ocr-workers", type=int, default=None)
+    parser.add_argument("--index-pages", type=int, nargs="*", default=[10, 100, 1000])
+    parser.add_argument("--real-embedder", action="store_true")
+    parser.add_argument("--chunks", type=int, nargs="*", default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument("--compare", default=None, help="Earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = []
+
+    def record(stage, case, metric, result):
+        results.append({"stage": stage, "case": case, "metric": metric, **result})
+        print(f"{stage:<8} {case:<22} {metric} = {result[metric]:.3f}, peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    if "extract" in args.stages:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for scanned, sizes in ((False, args.text_pages), (True, args.scan_pages)):
+                kind = "scan" if scanned else "text"
+                for pages in sizes:
+                    path = os.path.join(tmp_dir, f"{kind}_{pages}.pdf")
+                    make_pdf(path, pages, scanned=scanned)
+                    record("extract", f"{kind}_{pages}p", "seconds", run_isolated(run_extract, path, pages, args.ocr_workers))
+
+    if "index" in args.stages:
+        for pages in args.index_pages:
+            record("index", f"{pages}p", "seconds", run_isolated(run_index, pages, args.real_embedder))
+
+    if "search" in args.stages:
+        for num_chunks in args.chunks:
+            record("search", f"{num_chunks}_chunks", "p50_ms", run_isolated(run_search, num_chunks, args.queries, args.top_k))
+
+    if "context" in args.stages:
+        for top_k in (args.top_k, args.top_k * 4):
+            record("context", f"top_{top_k}", "us_per_call", run_isolated(run_context, top_k, 10_000))
+
+    report = {
+        "commit": git_commit(),
+        "created": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "real_embedder": args.real_embedder,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            print("At least one case regressed beyond the tolerance")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# benchmarks/bench_startup.py
+#
+# Cold import time of the backend modules app.py imports, measured in fresh interpreters, and a check that
+# importing them does not pull in the heavy stack (torch, sentence_transformers, groq, faiss, PyMuPDF, pytesseract).
+# Exits non-zero when one of those is imported eagerly, so a regression shows up right away.
+#
+#   python -m benchmarks.bench_startup --runs 5
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+MODULES = ["backend.docstore", "backend.jobs", "backend.vectorstore", "backend.qa", "backend.answer_cache", "backend.metrics"]
+HEAVY_MODULES = ["torch", "sentence_transformers", "groq", "faiss", "fitz", "pytesseract"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure_once() -> dict:
+    code = PROBE.format(modules=MODULES, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold import time of the backend modules")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [measure_once() for _ in range(args.runs)]
+    seconds = [run["seconds"] for run in runs]
+    loaded = sorted({name for run in runs for name in run["loaded"]})
+    print(f"import {', '.join(MODULES)}: median {statistics.median(seconds) * 1000:.0f} ms, min {min(seconds) * 1000:.0f} ms over {args.runs} runs")
+    if loaded:
+        print(f"Heavy modules imported at startup: {', '.join(loaded)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
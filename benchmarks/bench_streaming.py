@@ -0,0 +1,45 @@
+# benchmarks/bench_streaming.py
+#
+# Time to first token and total latency of ask_groq_stream against the blocking ask_groq,
+# using the local fake completion server (no network or API key needed).
+#
+#   python -m benchmarks.bench_streaming --runs 20
+
+import argparse
+import os
+import statistics
+import time
+
+from benchmarks.fake_completion_server import start_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming vs blocking answer latency")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    server = start_server()
+    os.environ["GROQ_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.setdefault("GROQ_API_KEY", "fake")
+    from backend import qa
+
+    blocking, first_tokens, streamed = [], [], []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        qa.ask_groq("What is in the document?", context="Some context")
+        blocking.append(time.perf_counter() - start)
+
+        stats = {}
+        answer = "".join(qa.ask_groq_stream("What is in the document?", context="Some context", stats=stats))
+        assert answer.strip(), "The stream returned no text"
+        first_tokens.append(stats["time_to_first_token"])
+        streamed.append(stats["total_latency"])
+    server.shutdown()
+
+    print(f"blocking answer          median {statistics.median(blocking) * 1000:8.1f} ms")
+    print(f"streamed first token     median {statistics.median(first_tokens) * 1000:8.1f} ms")
+    print(f"streamed complete answer median {statistics.median(streamed) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
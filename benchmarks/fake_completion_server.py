@@ -0,0 +1,89 @@
+# benchmarks/fake_completion_server.py
+#
+# A local stand-in for the Groq chat completions endpoint, so streaming can be exercised without network access.
+# It answers both plain and streamed (server-sent events) requests with a canned reply, emitting one word at a time.
+#
+#   python -m benchmarks.fake_completion_server --port 8765
+#   GROQ_BASE_URL=http://127.0.0.1:8765 GROQ_API_KEY=fake streamlit run app.py
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = "This is a canned answer from the fake completion server. It arrives one word at a time."
+
+
+class FakeCompletionHandler(BaseHTTPRequestHandler):
+    first_token_delay = 0.2   # Seconds before the first token, like model prefill
+    token_delay = 0.02        # Seconds between tokens
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = body.get("model", "fake")
+        if body.get("stream"):
+            self._stream(model)
+        else:
+            self._complete(model)
+
+    def _chunk(self, model, delta, finish_reason=None):
+        return {
+            "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def _stream(self, model):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        time.sleep(self.first_token_delay)
+        events = [self._chunk(model, {"role": "assistant", "content": ""})]
+        events += [self._chunk(model, {"content": word + " "}) for word in REPLY.split()]
+        events.append(self._chunk(model, {}, "stop"))
+        for event in events:
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(self.token_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _complete(self, model):
+        time.sleep(self.first_token_delay + self.token_delay * len(REPLY.split()))
+        payload = json.dumps({
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": REPLY}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(REPLY.split()), "total_tokens": len(REPLY.split())},
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_server(port: int = 0) -> ThreadingHTTPServer:
+    # Starts the server on a background thread and returns it; port 0 picks a free port
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeCompletionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Groq chat completions server")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeCompletionHandler)
+    print(f"Serving fake completions on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
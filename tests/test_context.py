@@ -0,0 +1,70 @@
+# tests/test_context.py
+#
+# Packing retrieved chunks into the prompt context: neighbour merges, overlap joins, near-duplicates and the token
+# budget. Pure Python, no model or API key needed.
+#
+#   python -m pytest tests/test_context.py
+
+from backend.qa import MIN_MERGE_OVERLAP, _join_overlapping, _merge_neighbours, build_context_from_chunks, estimate_tokens
+
+
+def chunk(text, row, page=1, doc="a.pdf", vector=None):
+    return {"doc_name": doc, "page_number": page, "row": row, "text": text, "vector": vector}
+
+
+def test_join_keeps_the_shared_text_once():
+    shared = "the overlap between the two chunks"
+    assert _join_overlapping("First part, " + shared, shared + " and the rest.") == "First part, " + shared + " and the rest."
+
+
+def test_join_without_overlap_keeps_both_texts():
+    # Overlaps shorter than MIN_MERGE_OVERLAP are coincidences, not the splitter's overlap
+    first, second = "ends with the", "the start of something else"
+    assert len("the") < MIN_MERGE_OVERLAP
+    assert _join_overlapping(first, second) == first + "\n" + second
+
+
+def test_consecutive_rows_of_a_page_are_merged_where_the_best_one_ranked():
+    chunks = [chunk("row five", 5), chunk("other page", 6, page=2), chunk("row four", 4), chunk("row six", 6)]
+    sources = _merge_neighbours(chunks)
+    assert [source["text"] for source in sources] == ["row four\nrow five\nrow six", "other page"]
+    assert [source["merged"] for source in sources] == [3, 1]
+
+
+def test_rows_of_different_pages_or_documents_are_not_merged():
+    chunks = [chunk("a", 1), chunk("b", 2, page=2), chunk("c", 3, doc="b.pdf")]
+    assert len(_merge_neighbours(chunks)) == 3
+
+
+def test_near_duplicates_are_dropped():
+    chunks = [chunk("the payment terms are 30 days", 1, vector=[1.0, 0.0]),
+              chunk("payment terms: 30 days", 10, vector=[0.99, 0.01]),
+              chunk("the warranty lasts two years", 20, vector=[0.0, 1.0])]
+    stats = {}
+    build_context_from_chunks(chunks, stats=stats)
+    assert [source["row"] for source in stats["sources"]] == [1, 20]
+    assert stats["duplicates"] == 1
+
+
+def test_sources_are_packed_within_the_budget():
+    chunks = [chunk(f"chunk {i} " + "word " * 60, i * 10) for i in range(10)]
+    stats = {}
+    context = build_context_from_chunks(chunks, token_budget=200, stats=stats)
+    assert estimate_tokens(context) <= 200
+    assert 0 < len(stats["sources"]) < len(chunks)
+    assert stats["over_budget"] == len(chunks) - len(stats["sources"])
+    assert stats["tokens_saved"] == stats["baseline_tokens"] - stats["prompt_tokens"] > 0
+    assert context.startswith("Source [1] from Document 'a.pdf', Page 1:")
+
+
+def test_a_source_longer_than_the_budget_is_cut_down():
+    stats = {}
+    context = build_context_from_chunks([chunk("x" * 10_000, 1)], token_budget=100, stats=stats)
+    assert estimate_tokens(context) <= 100
+    assert len(stats["sources"]) == 1
+
+
+def test_no_chunks_give_no_context():
+    stats = {}
+    assert build_context_from_chunks([], stats=stats) is None
+    assert stats["sources"] == [] and stats["prompt_tokens"] == 0
@@ -0,0 +1,115 @@
+# tests/test_docstore.py
+#
+# The shared DocumentStore: adding, searching a chat's view, evicting idle documents, adding them back from the
+# embedding cache, compaction and the snapshot on disk. Embeds with the benchmarks' hashing embedder, so no model
+# is downloaded.
+#
+#   python -m pytest tests/test_docstore.py
+
+import random
+
+import pytest
+
+from backend import cache, docstore, vectorstore
+from backend.docstore import DocumentStore
+from benchmarks.bench_pipeline import HashingEmbedder, page_text
+
+
+class CountingEmbedder(HashingEmbedder):
+    def __init__(self):
+        super().__init__()
+        self.texts = 0
+
+    def encode(self, texts, *args, **kwargs):
+        self.texts += len(texts)
+        return super().encode(texts, *args, **kwargs)
+
+
+@pytest.fixture
+def embedder(tmp_path, monkeypatch):
+    embedder = CountingEmbedder()
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(vectorstore, "get_embedder", lambda: embedder)
+    return embedder
+
+
+def document(file_hash, pages=5, seed=0):
+    rng = random.Random(seed)
+    return {"pages": [{"text": page_text(rng, i), "page_number": i + 1} for i in range(pages)],
+            "metadata": {"author": "x", "title": "t", "creation_date": None}, "hash": file_hash}
+
+
+A, B = document("a" * 64, pages=8, seed=1), document("b" * 64, pages=2, seed=2)
+
+
+def test_search_is_restricted_to_the_view_and_uses_its_names(embedder):
+    store = DocumentStore()
+    assert store.add(A, notify=print) and store.add(B, notify=print)
+    hits = store.search("invoice section", {"report.pdf": A}, top_k=5, notify=print)
+    assert hits and {hit["doc_name"] for hit in hits} == {"report.pdf"}
+    assert all(hit["chunk_id"].startswith("report.pdf") for hit in hits)
+
+
+def test_the_same_content_is_added_once(embedder):
+    store = DocumentStore()
+    store.add(A, notify=print)
+    embedded = embedder.texts
+    store.add(dict(A), notify=print)
+    assert len(store) == 1 and embedder.texts == embedded
+
+
+def test_evicted_documents_come_back_from_the_embedding_cache(embedder, monkeypatch):
+    store = DocumentStore()
+    store.add(A, notify=print)
+    published = store.index
+    monkeypatch.setattr(docstore, "IDLE_SECONDS", -1)
+    store._maintain()
+    assert len(store) == 0 and store.index is None
+    # The index searches were using is left as it was
+    assert published.ntotal > 0
+
+    monkeypatch.setattr(docstore, "IDLE_SECONDS", 3600)
+    embedded = embedder.texts
+    hits = store.search("invoice", {"report.pdf": A}, top_k=3, notify=print)
+    assert hits and len(store) == 1
+    assert embedder.texts == embedded + 1  # Only the query
+
+
+def test_dead_rows_are_compacted_away(embedder):
+    store = DocumentStore()
+    store.add(A, notify=print)
+    store.add(B, notify=print)
+    rows_of_b = len(store.store.rows_for_documents([B["hash"]]))
+    # A holds most of the rows; evicting it leaves more dead rows than live ones
+    store._docs[A["hash"]]["last_used"] = 0
+    store._maintain()
+    assert A["hash"] not in store and B["hash"] in store
+    assert len(store.store) == store.store.live_count == rows_of_b
+    assert store.index.ntotal == rows_of_b
+    assert store.search("invoice", {"b.pdf": B}, top_k=3, notify=print)
+
+
+def test_snapshot_is_reopened_from_disk(embedder, tmp_path):
+    directory = str(tmp_path / "docstore")
+    store = DocumentStore(directory)
+    store.add(A, notify=print)
+    store.add(B, notify=print)
+    view = {"a.pdf": A, "b.pdf": B}
+    expected = [(hit["doc_name"], hit["page_number"]) for hit in store.search("invoice section 3", view, top_k=4)]
+
+    embedded = embedder.texts
+    reopened = DocumentStore.open(directory)
+    assert len(reopened) == 2 and reopened.index.ntotal == store.index.ntotal
+    assert [(hit["doc_name"], hit["page_number"]) for hit in reopened.search("invoice section 3", view, top_k=4)] == expected
+    assert embedder.texts == embedded + 1  # Only the query
+
+    # The loaded store is only read from; adding works on copies
+    assert reopened.add(document("c" * 64, pages=1, seed=3), notify=print)
+    assert len(DocumentStore.open(directory)) == 3
+
+
+def test_snapshot_from_other_settings_is_ignored(embedder, tmp_path, monkeypatch):
+    directory = str(tmp_path / "docstore")
+    DocumentStore(directory).add(A, notify=print)
+    monkeypatch.setattr(vectorstore, "CHUNK_SIZE", vectorstore.CHUNK_SIZE + 100)
+    assert len(DocumentStore.open(directory)) == 0
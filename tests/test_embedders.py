@@ -0,0 +1,39 @@
+# tests/test_embedders.py
+#
+# Parity of the faster CPU embedding backends with the PyTorch model. Needs a local copy of all-MiniLM-L6-v2
+# (with its onnx/ folder) in DOCBOT_EMBEDDING_MODEL_PATH and is skipped without one.
+#
+#   DOCBOT_EMBEDDING_MODEL_PATH=./models/all-MiniLM-L6-v2 python -m pytest tests/test_embedders.py
+
+import os
+
+import numpy as np
+import pytest
+
+from backend.embedders import EMBEDDING_BACKENDS, load_embedder
+from benchmarks.bench_embedders import cosine_rows, synthetic_texts
+
+MODEL_PATH = os.environ.get("DOCBOT_EMBEDDING_MODEL_PATH")
+MIN_COSINE = 0.98
+
+pytestmark = pytest.mark.skipif(not MODEL_PATH or not os.path.isdir(MODEL_PATH), reason="DOCBOT_EMBEDDING_MODEL_PATH is not a local model directory")
+
+
+@pytest.fixture(scope="module")
+def texts():
+    return synthetic_texts(200)
+
+
+@pytest.fixture(scope="module")
+def reference(texts):
+    pytest.importorskip("sentence_transformers")
+    model = load_embedder("all-MiniLM-L6-v2", backend="torch", model_path=MODEL_PATH)
+    return np.asarray(model.encode(texts, batch_size=64), dtype='float32')
+
+
+@pytest.mark.parametrize("backend", [b for b in EMBEDDING_BACKENDS if b != "torch"])
+def test_backend_matches_pytorch(backend, texts, reference):
+    model = load_embedder("all-MiniLM-L6-v2", backend=backend, model_path=MODEL_PATH)
+    vectors = np.asarray(model.encode(texts, batch_size=64), dtype='float32')
+    assert vectors.shape == reference.shape
+    assert cosine_rows(vectors, reference).min() >= MIN_COSINE
@@ -0,0 +1,33 @@
+# tests/test_indexes.py
+#
+# Building FAISS indexes batch by batch when the number of vectors is only an estimate.
+#
+#   python -m pytest tests/test_indexes.py
+
+import numpy as np
+import pytest
+
+from backend.indexes import IndexBuilder, index_type_of
+
+DIMENSION = 32
+
+
+def build(num_vectors, estimate, index_type=None, batch=128):
+    vectors = np.random.default_rng(0).random((num_vectors, DIMENSION), dtype=np.float32)
+    builder = IndexBuilder(None, estimate, index_type)
+    for start in range(0, num_vectors, batch):
+        builder.add(vectors[start:start + batch], np.arange(start, min(start + batch, num_vectors)))
+    return builder.finish(), vectors
+
+
+@pytest.mark.parametrize("index_type", [None, "ivf_flat", "ivf_pq"])
+def test_fewer_vectors_than_estimated_still_build(index_type):
+    index, vectors = build(500, 60_000, index_type)
+    assert index.ntotal == 500
+    _, ids = index.search(vectors[:1], 1)
+    assert ids[0, 0] == 0
+
+
+def test_a_matching_estimate_builds_the_approximate_type():
+    index, _ = build(5_000, 5_000, "ivf_flat")
+    assert index_type_of(index) == "ivf_flat" and index.ntotal == 5_000
@@ -0,0 +1,90 @@
+# tests/test_lexical.py
+#
+# The BM25 index behind the lexical half of hybrid search: tokens, adding and removing rows, restricting a search to
+# a mask of rows, skipping common terms, and saving and loading.
+#
+#   python -m pytest tests/test_lexical.py
+
+import numpy as np
+
+from backend import lexical
+from backend.lexical import BM25Index, tokenize
+
+
+def index_of(texts):
+    index = BM25Index()
+    for row, text in enumerate(texts):
+        index.add(row, text)
+    return index
+
+
+def test_ids_and_unicode_words_stay_single_tokens():
+    assert tokenize("Invoice INV-2023-0042, clause 4.2.1 dated 12/03/2024") == ["invoice", "inv-2023-0042", "clause", "4.2.1", "dated", "12/03/2024"]
+    assert tokenize("Größe des Cafés") == ["größe", "des", "cafés"]
+
+
+def test_exact_terms_rank_their_rows_first():
+    index = index_of(["the payment is due", "invoice INV-2023-0042 is due", "the warranty", "INV-2023-0042 INV-2023-0042 again"])
+    assert index.search("INV-2023-0042", top_k=5) == [3, 1]
+    assert index.search("nothing matches", top_k=5) == []
+
+
+def test_removed_rows_are_not_found():
+    index = index_of(["alpha beta", "alpha gamma", "delta"])
+    index.remove([0])
+    assert len(index) == 2
+    assert index.search("alpha", top_k=5) == [1]
+    assert index.search("beta", top_k=5) == []
+    # Removing again changes nothing
+    index.remove([0])
+    assert len(index) == 2
+
+
+def test_rows_added_after_a_gap_are_found():
+    index = BM25Index()
+    index.add(0, "alpha")
+    index.add(5, "alpha beta")
+    assert index.search("beta", top_k=5) == [5]
+    assert sorted(index.search("alpha", top_k=5)) == [0, 5]
+
+
+def test_search_is_restricted_to_the_mask():
+    index = index_of(["alpha one", "alpha two", "alpha three"])
+    mask = np.array([False, True, True])
+    assert sorted(index.search("alpha", top_k=5, allowed_mask=mask)) == [1, 2]
+    assert index.search("one", top_k=5, allowed_mask=mask) == []
+
+
+def test_copies_are_independent():
+    index = index_of(["alpha", "beta"])
+    copy = index.copy()
+    copy.remove([0])
+    copy.add(2, "alpha again")
+    assert index.search("alpha", top_k=5) == [0]
+    assert copy.search("alpha", top_k=5) == [2]
+
+
+def test_queries_of_only_common_terms_get_no_hits(monkeypatch):
+    monkeypatch.setattr(lexical, "MIN_DF_CUTOFF", 0)
+    index = index_of([f"the report part {i}" + (" warranty" if i == 7 else "") for i in range(20)])
+    assert index.search("the report", top_k=5) == []
+    assert index.search("the warranty", top_k=5) == [7]
+
+
+def test_small_stores_score_common_terms():
+    # Below MIN_DF_CUTOFF rows every posting list is short enough to score
+    index = index_of(["the cat", "the dog"])
+    assert sorted(index.search("the", top_k=5)) == [0, 1]
+
+
+def test_saved_index_loads_with_the_same_results(tmp_path):
+    index = index_of(["alpha beta", "alpha gamma", "delta alpha alpha"])
+    index.remove([1])
+    for name, writer in index.files().items():
+        writer(str(tmp_path / name))
+    loaded = BM25Index.load(str(tmp_path))
+    assert len(loaded) == len(index)
+    for query in ("alpha", "gamma", "delta beta"):
+        assert loaded.search(query, top_k=5) == index.search(query, top_k=5)
+    loaded.add(3, "gamma")
+    assert loaded.search("gamma", top_k=5) == [3]
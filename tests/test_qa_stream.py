@@ -0,0 +1,45 @@
+# tests/test_qa_stream.py
+#
+# ask_groq_stream against the local fake completion server, so no network or API key is needed.
+#
+#   python -m pytest tests/test_qa_stream.py
+
+import importlib
+
+import pytest
+
+from benchmarks.fake_completion_server import REPLY, start_server
+
+
+@pytest.fixture(scope="module")
+def qa():
+    server = start_server()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("GROQ_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}")
+        mp.setenv("GROQ_API_KEY", "fake")
+        # GROQ_BASE_URL is read when backend.qa is imported, and the client is created once per process
+        from backend import qa
+        qa = importlib.reload(qa)
+        qa._create_groq_client.clear()
+        yield qa
+        qa._create_groq_client.clear()
+    server.shutdown()
+
+
+def test_stream_yields_the_reply_piece_by_piece(qa):
+    stats = {}
+    pieces = list(qa.ask_groq_stream("What is in the document?", context="Some context", stats=stats))
+    assert len(pieces) > 1
+    assert "".join(pieces).strip() == REPLY
+    assert 0 < stats["time_to_first_token"] < stats["total_latency"]
+
+
+def test_stream_reports_api_errors(qa, monkeypatch):
+    # get_groq_client returns None when no client could be created
+    monkeypatch.setattr(qa, "get_groq_client", lambda: None)
+    stats = {}
+    pieces = list(qa.ask_groq_stream("What is in the document?", stats=stats))
+    assert len(pieces) == 1
+    assert pieces[0].startswith("❌ Error while calling Groq API")
+    assert "time_to_first_token" not in stats
+    assert stats["total_latency"] >= 0